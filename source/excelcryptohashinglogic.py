@@ -21,78 +21,1327 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
     """
 
+import base64
+import binascii
+import csv
 import gc
+import gzip
+import hashlib
+import io
+import json
+import math
 import os.path
+import posixpath
+import queue
 import re
-import sys
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import groupby, islice, repeat
+from operator import itemgetter
 from shutil import copyfile
+from xml.etree import ElementTree
 
-import pandas as pd
-import sqlalchemy as sa
-import xlwings as xw
-from Crypto.Hash import RIPEMD, SHA224, SHA256, SHA384, SHA512
-from openpyxl import load_workbook
+# The temporary database only holds scratch data that is rebuilt from the input on failure, so durability is
+# traded for speed.
+scratch_pragmas = ('PRAGMA journal_mode = OFF', 'PRAGMA synchronous = OFF', 'PRAGMA temp_store = MEMORY',
+                   'PRAGMA cache_size = -65536')
 
+# A state file kept between incremental runs must survive a failed run, so it keeps a journal.
+state_pragmas = ('PRAGMA journal_mode = WAL', 'PRAGMA synchronous = NORMAL', 'PRAGMA temp_store = MEMORY',
+                 'PRAGMA cache_size = -65536')
 
-class StringFolder(object):
+# Output writers running in worker processes only read the temporary database, see write_outputs. Their
+# temporary tables (see lookup_hashes) are kept in memory.
+output_pragmas = ('PRAGMA temp_store = MEMORY', 'PRAGMA cache_size = -65536')
+
+# Hash formats offered for processing, in the order of the hash2use values accepted by identify_hash.
+hash_formats = ('ripemd160', 'sha224', 'sha256', 'sha384', 'sha512')
+
+# Hash values are stored as binary digests and only encoded as text when written out. SQL expressions encoding a
+# digest column, by encoding name; base64 is registered with every connection to the temporary database.
+digest_encodings = {'hex': 'lower(hex({0}))', 'base64': 'base64({0})'}
+
+# Maximum number of rows of an Excel sheet, including the header row
+excel_max_rows = 1048576
+
+# Normalization rules that may be applied to the values of a field/column before hashing, see normalize_values.
+# zfill takes the width to pad to, e.g. 'zfill:9'.
+normalization_rules = ('trim', 'casefold', 'zfill', 'punct')
+
+
+class OperationCancelled(Exception):
+    """ Raised between chunks and stages once ExcelCryptoHash.cancel has been called. Everything committed to the
+        temporary database up to then is kept; with a state file, a rerun resumes from there.
+    """
+
+
+def hash_constructor(hstr):
+    """ Return a callable that creates a new hash object for the named algorithm, optionally primed with data.
+        hashlib is used wherever possible as it is considerably cheaper per call than pycryptodome. RIPEMD-160
+        falls back to pycryptodome when the local OpenSSL build does not provide it.
+
+    :param hstr: Name of the cryptographic hash (e.g. 'sha512', 'ripemd160')
+    :return: Hash object constructor accepting the bytes to be hashed.
     """
-    Class that will fold strings. See 'fold_string'.
-    This object may be safely deleted or go out of scope when
-    strings have been folded.
+    try:
+        hashlib.new(hstr)
+    except ValueError:
+        if hstr == 'ripemd160':
+            from Crypto.Hash import RIPEMD
+
+            return RIPEMD.new
+        raise
+    return getattr(hashlib, hstr, None) or (lambda data=b'': hashlib.new(hstr, data))
+
+
+def hash_chunk(hstr, texts):
+    """ Hash a chunk of text values. Defined at module level so that chunks can be dispatched to worker processes.
+
+    :param hstr: Name of the cryptographic hash to use
+    :param texts: List of text values to be hashed
+    :return: List of binary digests in the same order as texts
     """
+    new = hash_constructor(hstr)
+    return [new(text.encode('utf-8')).digest() for text in texts]
 
-    def __init__(self):
-        self.unicode_map = {}
-
-    def fold_string(self, s):
-        """
-        Given a string (or unicode) parameter s, return a string object
-        that has the same value as s (and may be s). For all objects
-        with a given value, the same object will be returned. For unicode
-        objects that can be coerced to a string with the same value, a
-        string object will be returned.
-        If s is not a string or unicode object, it is returned unchanged.
-        :param s: a string or unicode object.
-        :return: a string or unicode object.
-        """
-        # If s is not a string or unicode object, return it unchanged
-        if not isinstance(s, str):
-            return s
-
-        # If s is already a string, then str() has no effect.
-        # If s is Unicode, try and encode as a string and use intern.
-        # If s is Unicode and can't be encoded as a string, this try
-        # will raise a UnicodeEncodeError.
+
+def hash_chunk_multi(hstrs, texts):
+    """ Hash a chunk of text values with several hash formats in one loop, encoding every value only once.
+
+    :param hstrs: Names of the cryptographic hashes to use
+    :param texts: List of text values to be hashed
+    :return: List with a tuple of binary digests, in the order of hstrs, for every value in texts
+    """
+    news = [hash_constructor(hstr) for hstr in hstrs]
+    digests = []
+    for text in texts:
+        data = text.encode('utf-8')
+        digests.append(tuple(new(data).digest() for new in news))
+    return digests
+
+
+def write_output(settings, part, hstr, arguments, cancelled=None):
+    """ Write one output from the temporary database in a worker process, see ExcelCryptoHash.write_outputs.
+
+    :param settings: Attributes of the ExcelCryptoHash instance that created the temporary database
+    :param part: 'summary' or 'detail' mapfile, or 'output' for a Hashed_ copy of an input file
+    :param hstr: Hash format whose hash values are written
+    :param arguments: Arguments of write_excel_mapfiles, write_flat_mapfiles or write_hashed_outputfile
+    :param cancelled: Optional cancellation token shared with the calling process, e.g. a multiprocessing.Manager
+                      Event, see ExcelCryptoHash.cancel
+    :return: Tuple of the result of the writer and the statistics of its stages
+    """
+    writer = ExcelCryptoHash()
+    for name, value in settings.items():
+        setattr(writer, name, value)
+    if cancelled is not None:
+        writer.cancelled = cancelled
+    writer.connect_sqlite(settings['dbname'], output_pragmas)
+    try:
+        writer.select_hash(hstr)
+        if part == 'output':
+            result = writer.write_hashed_outputfile(*arguments)
+        elif writer.outputformat == 'xlsx':
+            result = writer.write_excel_mapfiles(*arguments, parts=(part,))
+        else:
+            result = writer.write_flat_mapfiles(*arguments, parts=(part,))
+    finally:
+        writer.SQLiteconnection.dispose()
+    return result, writer.statistics.stages
+
+
+def encode_base64(digest):
+    """ Encode a binary digest as base64 text. Registered as SQL function base64, see digest_encodings.
+
+    :param digest: Binary digest, or None
+    :return: base64 text, or None
+    """
+    return None if digest is None else base64.b64encode(digest).decode('ascii')
+
+
+def decode_digest(text):
+    """ Decode a hash value written as hex or base64 text back to the binary digest.
+
+    :param text: Hex or base64 hash value. Case of hex and surrounding white space are ignored.
+    :return: Binary digest, or None when text is neither valid hex nor valid base64
+    """
+    text = text.strip()
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        pass
+    try:
+        return base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def chunked(iterable, size):
+    """ Split an iterable into lists of at most size items.
+
+    :param iterable: Items to be split
+    :param size: Maximum number of items per list
+    :return: Iterator of lists
+    """
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def write_cells(worksheet, r, row, numberformats=None):
+    """ Write a row of cells read by openpyxl with xlsxwriter. Formula cells are written as formulas and every other
+        value as it is, so that text starting with '=' stays text. Array formulas are written as array formulas in
+        their top-left cell (the other cells of a multi-cell array keep their cached values), and data table
+        formulas, which xlsxwriter cannot write, as their TABLE() text.
+
+    :param worksheet: xlsxwriter Worksheet
+    :param r: Zero-based row number
+    :param row: Tuple of openpyxl cells, as read by iter_rows(), or of plain values such as the hash values put in
+                by replace_hashed_values
+    :param numberformats: Optional NumberFormats of the workbook, to keep the number formats of the cells
+    """
+    from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
+
+    for c, cell in enumerate(row):
+        value, datatype, cellformat = cell, None, None
+        if hasattr(cell, 'data_type'):
+            value, datatype = cell.value, cell.data_type
+            if numberformats is not None:
+                cellformat = numberformats[cell.number_format]
+        if value is None:
+            if cellformat is not None:
+                worksheet.write_blank(r, c, None, cellformat)
+        elif isinstance(value, ArrayFormula):
+            worksheet.write_array_formula(r, c, r, c, value.text, cellformat)
+        elif isinstance(value, DataTableFormula):
+            worksheet.write_string(r, c, '=TABLE({0},{1})'.format(value.r1 or '', value.r2 or ''), cellformat)
+        elif datatype == 'f':
+            worksheet.write_formula(r, c, value, cellformat)
+        elif isinstance(value, str):
+            worksheet.write_string(r, c, value, cellformat)
+        else:
+            worksheet.write(r, c, value, cellformat)
+
+
+class NumberFormats(dict):
+    """ The xlsxwriter Formats of the number formats of the cells copied into a workbook, added on first use. """
+
+    def __init__(self, workbook):
+        """
+        :param workbook: xlsxwriter Workbook
+        """
+        super(NumberFormats, self).__init__()
+        self.workbook = workbook
+
+    def __missing__(self, code):
+        cellformat = None if code in (None, 'General') else self.workbook.add_format({'num_format': code})
+        self[code] = cellformat
+        return cellformat
+
+
+def excel_sheet_name(field):
+    """ Turn a field/column name into a valid Excel sheet name.
+
+    :param field: Field/column name
+    :return: Name without characters Excel does not allow, at most 30 characters long
+    """
+    field = re.sub(r'[\<\>\*\\\/\?|:\[\]]', '_', str(field))
+    field = re.sub('History', 'Hist', field, flags=re.IGNORECASE)
+    return field[0:30].strip()
+
+
+def unique_sheet_name(name, used):
+    """ Make a sheet name unique within a workbook, as Excel compares sheet names case-insensitively.
+
+    :param name: Valid Excel sheet name
+    :param used: Set of the lower-cased sheet names already in the workbook. The returned name is added to it.
+    :return: name, or name with a numeric suffix if name is already in use
+    """
+    candidate = name
+    suffix = 1
+    while candidate.lower() in used:
+        suffix += 1
+        candidate = name[0:30 - len(str(suffix)) - 1] + '_' + str(suffix)
+    used.add(candidate.lower())
+    return candidate
+
+
+def shard_count(rows, maxrows):
+    """ Number of sheets needed to hold a number of rows below a header row.
+
+    :param rows: Number of data rows
+    :param maxrows: Maximum number of rows of a sheet, including the header row
+    :return: Number of sheets, at least one
+    """
+    return max(1, int(math.ceil(rows / float(maxrows - 1))))
+
+
+class ShardedWorksheet(object):
+    """ A sheet of an xlsxwriter workbook that rolls over to numbered sheets (name, name_2, ...), each starting with
+        the header row, once maxrows rows are written, so that more values than fit in one Excel sheet are written
+        instead of failing at the end of a run. The sheets expected are added up front, so that they stay together
+        in the workbook; a sheet is added on demand should more rows arrive.
+    """
+
+    def __init__(self, workbook, name, used, header, rows=0, maxrows=excel_max_rows, headerformat=None):
+        """
+        :param workbook: xlsxwriter Workbook
+        :param name: Valid Excel sheet name of the first sheet
+        :param used: Set of the lower-cased sheet names already in the workbook, see unique_sheet_name
+        :param header: Column names written as the first row of every sheet
+        :param rows: Number of data rows expected, see shard_count
+        :param maxrows: Maximum number of rows of a sheet, including the header row
+        :param headerformat: Optional xlsxwriter Format of the header row
+        """
+        self.workbook = workbook
+        self.name = name
+        self.used = used
+        self.header = header
+        self.headerformat = headerformat
+        self.capacity = maxrows - 1
+        self.sheets = []
+        self.written = 0
+        for shard in range(shard_count(rows, maxrows)):
+            self.add_sheet()
+
+    def add_sheet(self):
+        worksheet = self.workbook.add_worksheet(unique_sheet_name(self.name, self.used))
+        worksheet.write_row(0, 0, self.header, self.headerformat)
+        self.sheets.append(worksheet)
+
+    def write_row(self, row):
+        shard, r = divmod(self.written, self.capacity)
+        if shard == len(self.sheets):
+            self.add_sheet()
+        self.sheets[shard].write_row(r + 1, 0, row)
+        self.written += 1
+
+
+# Parts a worksheet added to a workbook package is registered in, see WorkbookPackage
+worksheet_content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+worksheet_relationship = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+
+
+def sheet_cell_xml(reference, value):
+    """ XML of a cell of a worksheet part, see WorksheetPart.
+
+    :param reference: Cell reference, e.g. 'B2'
+    :param value: Cell value; text is written as an inline string, so that it is never taken for a formula
+    :return: XML of the cell, or an empty string for None
+    """
+    from xml.sax.saxutils import escape
+
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '<c r="{0}" t="b"><v>{1:d}</v></c>'.format(reference, value)
+    if isinstance(value, int) or (isinstance(value, float) and math.isfinite(value)):
+        return '<c r="{0}"><v>{1!r}</v></c>'.format(reference, value)
+    return '<c r="{0}" t="inlineStr"><is><t xml:space="preserve">{1}</t></is></c>'.format(reference,
+                                                                                        escape(str(value)))
+
+
+class WorksheetPart(object):
+    """ A worksheet streamed straight into the archive of a workbook package as XML, one chunk of rows at a time,
+        see WorkbookPackage.add_worksheet.
+    """
+
+    def __init__(self, archive, partname, header):
+        """
+        :param archive: ZipFile the part is written to
+        :param partname: Name of the part in the archive, e.g. 'xl/worksheets/sheet4.xml'
+        :param header: Column names written as the first row
+        """
+        self.partname = partname
+        self.file = archive.open(partname, 'w', force_zip64=True)
+        self.file.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+        self.rows = 0
+        self.write_rows([header])
+
+    def write_rows(self, rows):
+        texts = []
+        for row in rows:
+            self.rows += 1
+            texts.append('<row r="{0}">'.format(self.rows))
+            texts.extend(sheet_cell_xml(string.ascii_uppercase[c] + str(self.rows), value)
+                         for c, value in enumerate(row))
+            texts.append('</row>')
+        self.file.write(''.join(texts).encode('utf-8'))
+
+    def close(self):
+        self.file.write(b'</sheetData></worksheet>')
+        self.file.close()
+
+
+class ShardedWorksheetPart(object):
+    """ The WorksheetPart counterpart of ShardedWorksheet: rolls over to numbered sheets (name, name_2, ...), each
+        starting with the header row, once maxrows rows are written. A package is written one part at a time, so a
+        sheet is only added once its first row arrives.
+    """
+
+    def __init__(self, package, name, used, header, maxrows=excel_max_rows):
+        """
+        :param package: WorkbookPackage
+        :param name: Valid Excel sheet name of the first sheet
+        :param used: Set of the lower-cased sheet names already in the workbook, see unique_sheet_name
+        :param header: Column names written as the first row of every sheet
+        :param maxrows: Maximum number of rows of a sheet, including the header row
+        """
+        self.package = package
+        self.name = name
+        self.used = used
+        self.header = header
+        self.capacity = maxrows - 1
+        self.sheet = None
+        self.sheets = 0
+        self.written = 0
+
+    def add_sheet(self):
+        if self.sheet is not None:
+            self.sheet.close()
+        self.sheet = self.package.add_worksheet(unique_sheet_name(self.name, self.used), self.header)
+        self.sheets += 1
+
+    def write_rows(self, rows):
+        while rows:
+            if self.sheet is None or self.written == self.capacity:
+                self.add_sheet()
+                self.written = 0
+            count = min(len(rows), self.capacity - self.written)
+            self.sheet.write_rows(rows[:count])
+            self.written += count
+            rows = rows[count:]
+
+    def close(self):
+        # A column without values still gets its sheet
+        if not self.sheets:
+            self.add_sheet()
+        self.sheet.close()
+
+
+class WorkbookPackage(object):
+    """ A copy of an Excel 2007+ workbook with worksheets added to it. Every part of the input is copied byte for
+        byte, except the three that list the sheets, so that cell values and types, formulas, formatting, merged
+        cells, column widths, charts and macros all stay as they are. Use copy_parts, then add_worksheet, then
+        finish to register the added sheets, and always close.
+    """
+
+    # Parts rewritten by finish, which are copied from the input with the added sheets registered in them
+    listings = ('[Content_Types].xml', 'xl/workbook.xml', 'xl/_rels/workbook.xml.rels')
+
+    def __init__(self, inputname, outputname):
+        """
+        :param inputname: Path of the Excel input file
+        :param outputname: Path of the copy
+        """
+        self.source = zipfile.ZipFile(inputname)
+        self.archive = zipfile.ZipFile(outputname, 'w', zipfile.ZIP_DEFLATED)
+        self.partnames = set(self.source.namelist())
+        self.added = []
+
+    def copy_parts(self, check=None):
+        """ Copy the parts of the input file, except the listings of the sheets.
+
+        :param check: Optional callable called before every part is copied, e.g. ExcelCryptoHash.check_cancelled
+        """
+        import shutil
+
+        for info in self.source.infolist():
+            if check is not None:
+                check()
+            if info.filename in self.listings:
+                continue
+            with self.source.open(info) as source, \
+                    self.archive.open(self.copy_info(info), 'w', force_zip64=True) as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+
+    @staticmethod
+    def copy_info(info):
+        copy = zipfile.ZipInfo(info.filename, info.date_time)
+        copy.compress_type = zipfile.ZIP_DEFLATED
+        copy.external_attr = info.external_attr
+        return copy
+
+    def add_worksheet(self, sheetname, header):
+        """ Add a worksheet as a new part. Only one worksheet can be written at a time.
+
+        :param sheetname: Valid, unused Excel sheet name
+        :param header: Column names written as the first row
+        :return: WorksheetPart to write the rows to and close
+        """
+        number = len(self.partnames)
+        while 'xl/worksheets/sheet{0}.xml'.format(number) in self.partnames:
+            number += 1
+        partname = 'xl/worksheets/sheet{0}.xml'.format(number)
+        self.partnames.add(partname)
+        self.added.append((sheetname, partname))
+        return WorksheetPart(self.archive, partname, header)
+
+    def finish(self, after):
+        """ Write the listings of the sheets with the added worksheets registered in them. The added sheets are
+            placed after a sheet of the input file; sheet positions recorded in the workbook, such as those of
+            sheet-level defined names and the active sheet, are moved along with the sheets.
+
+        :param after: Name of the sheet the added worksheets are placed after
+        """
+        from xml.sax.saxutils import escape, quoteattr, unescape
+
+        contenttypes, workbook, relationships = (self.source.read(name).decode('utf-8') for name in self.listings)
+        existing = set(re.findall(r'\sId="([^"]*)"', relationships))
+        ids = []
+        for sheetname, partname in self.added:
+            number = len(existing) + len(ids) + 1
+            while 'rId{0}'.format(number) in existing:
+                number += 1
+            ids.append('rId{0}'.format(number))
+        existing.update(ids)
+
+        sheets = list(re.finditer(r'<(\w+:)?sheet\b[^>]*?(?:/>|>\s*</(?:\w+:)?sheet>)', workbook))
+        names = [unescape(re.search(r'\sname="([^"]*)"', sheet.group(0)).group(1), {'&quot;': '"', '&apos;': "'"})
+                 for sheet in sheets]
+        position = names.index(after) + 1
+        sheetid = max(int(re.search(r'\ssheetId="(\d+)"', sheet.group(0)).group(1)) for sheet in sheets)
+        prefix = sheets[0].group(1) or ''
+        idprefix = re.search(r'\s(\w+):id="', sheets[0].group(0)).group(1)
+        added = ''.join('<{0}sheet name={1} sheetId="{2}" {3}:id="{4}"/>'.format(
+            prefix, quoteattr(sheetname), sheetid + i + 1, idprefix, rid)
+            for i, ((sheetname, partname), rid) in enumerate(zip(self.added, ids)))
+
+        def move(match):
+            index = int(match.group(2))
+            return '{0}"{1}"'.format(match.group(1), index + len(self.added) if index >= position else index)
+
+        end = sheets[position - 1].end()
+        workbook = (re.sub(r'(\s(?:activeTab|firstSheet)=)"(\d+)"', move, workbook[:end]) + added +
+                    re.sub(r'(\slocalSheetId=)"(\d+)"', move, workbook[end:]))
+        relationships = re.sub(r'(</(?:\w+:)?Relationships>)', lambda match: ''.join(
+            '<Relationship Id="{0}" Type="{1}" Target={2}/>'.format(rid, worksheet_relationship,
+                                                                   quoteattr(partname[len('xl/'):]))
+            for (sheetname, partname), rid in zip(self.added, ids)) + match.group(1), relationships)
+        contenttypes = re.sub(r'(</(?:\w+:)?Types>)', lambda match: ''.join(
+            '<Override PartName="/{0}" ContentType="{1}"/>'.format(escape(partname), worksheet_content_type)
+            for sheetname, partname in self.added) + match.group(1), contenttypes)
+        for name, text in zip(self.listings, (contenttypes, workbook, relationships)):
+            self.archive.writestr(self.copy_info(self.source.getinfo(name)), text.encode('utf-8'))
+
+    def close(self):
+        self.archive.close()
+        self.source.close()
+
+
+def local_name(tag):
+    """ Strip the namespace from an XML tag, so that both transitional and strict OOXML workbooks are understood.
+
+    :param tag: ElementTree tag, e.g. '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}row'
+    :return: Tag without namespace, e.g. 'row'
+    """
+    return tag.rpartition('}')[2]
+
+
+def column_index(reference):
+    """ Convert a cell reference to a zero-based column index.
+
+    :param reference: Cell reference, e.g. 'AB1'
+    :return: Zero-based column index, e.g. 27
+    """
+    index = 0
+    for letter in reference:
+        if not letter.isalpha():
+            break
+        index = index * 26 + ord(letter.upper()) - ord('A') + 1
+    return index - 1
+
+
+class SharedStrings(object):
+    """
+    The shared strings table of a workbook, parsed only as far as the strings looked up so far. Holds the table
+    open in its archive until closed.
+    """
+
+    def __init__(self, archive, partname):
+        """
+        :param archive: Open ZipFile of the workbook
+        :param partname: Name of the shared strings part, or None when the workbook has none
+        """
+        self.strings = []
+        self.file = None if partname is None else archive.open(partname)
+        self.parser = None if self.file is None else ElementTree.iterparse(self.file, events=('end',))
+
+    def lookup(self, index):
+        """ Look up a shared string, parsing the shared strings table only as far as needed.
+
+        :param index: Zero-based index of the string
+        :return: Text of the string. Phonetic runs are ignored, as openpyxl does.
+        """
+        while index >= len(self.strings) and self.parser is not None:
+            for event, element in self.parser:
+                if local_name(element.tag) == 'si':
+                    texts = []
+                    for child in element:
+                        if local_name(child.tag) == 't':
+                            texts.append(child.text or '')
+                        elif local_name(child.tag) == 'r':
+                            texts.extend(run.text or '' for run in child if local_name(run.tag) == 't')
+                    self.strings.append(''.join(texts))
+                    element.clear()
+                    break
+            else:
+                self.parser = None
+        return self.strings[index]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class WorkbookProbe(object):
+    """
+    Read sheet names, header rows and sheet dimensions straight from the XML parts of an Excel 2007+ workbook. Every
+    sheet is parsed only up to the end of its first row, and shared strings only up to the last one a header refers
+    to, so that listing the columns of a wide or long sheet does not depend on its size. The archive is only open
+    while a sheet is probed, and only the sheet names, headers and dimensions are kept, so that probing many
+    workbooks holds neither file handles nor shared strings. Use probe_workbook to share probes between callers.
+    """
+
+    def __init__(self, fullname):
+        self.fullname = fullname
+        stat = os.stat(fullname)
+        self.signature = (stat.st_mtime, stat.st_size)
+        self.lock = threading.Lock()
+        self.headers = {}
+        self.dimensions = {}
+
+        targets = {}
+        # Name of the shared strings part, see SharedStrings
+        self.sharedstrings = None
+        with zipfile.ZipFile(fullname) as archive:
+            for relationship in ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels')):
+                target = relationship.get('Target')
+                target = target.lstrip('/') if target.startswith('/') else posixpath.normpath('xl/' + target)
+                targets[relationship.get('Id')] = target
+                if relationship.get('Type', '').endswith('/sharedStrings'):
+                    self.sharedstrings = target
+            self.sheets = OrderedDict()
+            for element in ElementTree.fromstring(archive.read('xl/workbook.xml')).iter():
+                if local_name(element.tag) == 'sheet':
+                    relationship = next(value for key, value in element.attrib.items() if local_name(key) == 'id')
+                    self.sheets[element.get('name')] = targets[relationship]
+
+    @property
+    def sheetnames(self):
+        return list(self.sheets)
+
+    def header(self, sheet2process):
+        """ Read the column names from the first row of a sheet.
+
+        :param sheet2process: Sheet to read
+        :return: Dictionary of column name to zero-based column index, as read_sheet_header
+        """
+        with self.lock:
+            if sheet2process not in self.headers:
+                self.probe_sheet(sheet2process)
+            return dict(self.headers[sheet2process])
+
+    def dimension(self, sheet2process):
+        """ The number of rows recorded in the dimension of a sheet.
+
+        :param sheet2process: Sheet to read
+        :return: Number of the last row, or None when the sheet does not record its dimension
+        """
+        with self.lock:
+            if sheet2process not in self.headers:
+                self.probe_sheet(sheet2process)
+            return self.dimensions[sheet2process]
+
+    def probe_sheet(self, sheet2process):
+        header = {}
+        cells = []
+        self.dimensions[sheet2process] = None
+        column = 0
+        value = celltype = None
+        with zipfile.ZipFile(self.fullname) as archive, archive.open(self.sheets[sheet2process]) as sheetfile:
+            for event, element in ElementTree.iterparse(sheetfile, events=('start', 'end')):
+                tag = local_name(element.tag)
+                if event == 'start':
+                    if tag == 'dimension':
+                        lastrow = re.sub('[^0-9]', '', element.get('ref', '').rpartition(':')[2])
+                        self.dimensions[sheet2process] = int(lastrow) if lastrow else None
+                    elif tag == 'row':
+                        if element.get('r', '1') != '1':
+                            break
+                    elif tag == 'c':
+                        if element.get('r'):
+                            column = column_index(element.get('r'))
+                        celltype = element.get('t', 'n')
+                        value = None
+                elif tag == 'v' or (tag == 't' and celltype == 'inlineStr'):
+                    value = (value or '') + (element.text or '')
+                elif tag == 'c':
+                    if value is not None:
+                        cells.append((column, celltype, value))
+                    column += 1
+                elif tag == 'row':
+                    break
+            with SharedStrings(archive, self.sharedstrings) as sharedstrings:
+                cells = [(column, celltype, sharedstrings.lookup(int(value)) if celltype == 's' else value)
+                         for column, celltype, value in cells]
+        for column, celltype, value in cells:
+            if celltype == 'n':
+                value = float(value) if any(c in value for c in '.eE') else int(value)
+            elif celltype == 'b':
+                value = value == '1'
+            header[value] = column
+        self.headers[sheet2process] = header
+
+
+# Workbook probes of the current session by file name, see probe_workbook
+workbook_probes = {}
+
+
+def probe_workbook(fullname):
+    """ Get the WorkbookProbe of an Excel file, reusing the probe of an earlier call as long as the file has not
+        changed since.
+
+    :param fullname: Path of the Excel input file
+    :return: WorkbookProbe
+    """
+    fullname = os.path.abspath(fullname)
+    probe = workbook_probes.get(fullname)
+    stat = os.stat(fullname)
+    if probe is None or probe.signature != (stat.st_mtime, stat.st_size):
+        probe = workbook_probes[fullname] = WorkbookProbe(fullname)
+    return probe
+
+
+def read_sheet_names(fullname):
+    """ Read the names of the sheets in an Excel file.
+
+    :param fullname: Path of the Excel input file
+    :return: List of sheet names in workbook order
+    """
+    return probe_workbook(fullname).sheetnames
+
+
+def read_sheet_header(fullname, sheet2process):
+    """ Read the column names from the first row of a sheet.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet to read.
+    :return: Dictionary of column name to zero-based column index
+    """
+    return probe_workbook(fullname).header(sheet2process)
+
+
+def estimate_sheet_rows(fullname, sheet2process):
+    """ Estimate the number of data rows of a sheet from the dimension recorded in the workbook, without reading
+        the rows themselves.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet to be estimated.
+    :return: Number of rows below the header row, or None when the workbook does not record the dimension.
+    """
+    maxrow = probe_workbook(fullname).dimension(sheet2process)
+    return None if maxrow is None else max(0, maxrow - 1)
+
+
+def read_sheet_layout(fullname, sheet2process):
+    """ Read the column widths and merged cells of a sheet, which openpyxl's read-only mode does not provide. Only
+        the XML before and after the cell data of the sheet is parsed; the cell data itself is skipped unparsed.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet to read
+    :return: Tuple of a list of (first column, last column, width, hidden) tuples, with width None when only the
+             visibility is set, and a list of (first row, first column, last row, last column) tuples of the merged
+             ranges. Rows and columns are zero-based.
+    """
+    from openpyxl.utils.cell import range_boundaries
+
+    head, tail = [], []
+    data = b''
+    with zipfile.ZipFile(fullname) as archive, \
+            archive.open(probe_workbook(fullname).sheets[sheet2process]) as sheetfile:
+        section = head
+        while True:
+            block = sheetfile.read(1 << 20)
+            data += block
+            if section is head:
+                match = re.search(rb'<(?:\w+:)?sheetData\b', data)
+                if match:
+                    head.append(data[:match.start()])
+                    data = data[match.start():]
+                    section = None
+            if section is None:
+                match = re.search(rb'</(?:\w+:)?sheetData>|<(?:\w+:)?sheetData\b[^>]*/>', data)
+                if match:
+                    data = data[match.end():]
+                    section = tail
+                else:
+                    # Keep enough to find an end tag split between blocks
+                    data = data[-64:]
+            if section is tail:
+                tail.append(data)
+                data = b''
+            if not block:
+                break
+    head = b''.join(head).decode('utf-8')
+    tail = b''.join(tail).decode('utf-8')
+
+    columns = []
+    for attributes in re.findall(r'<(?:\w+:)?col\b([^>]*)>', head):
+        attributes = dict(re.findall(r'(\w+)="([^"]*)"', attributes))
+        columns.append((int(attributes['min']) - 1, int(attributes['max']) - 1,
+                        float(attributes['width']) if 'width' in attributes else None,
+                        attributes.get('hidden') in ('1', 'true')))
+    merges = []
+    for reference in re.findall(r'<(?:\w+:)?mergeCell\b[^>]*\sref="([^"]+)"', tail):
+        mincol, minrow, maxcol, maxrow = range_boundaries(reference)
+        merges.append((minrow - 1, mincol - 1, maxrow - 1, maxcol - 1))
+    return columns, merges
+
+
+def read_sheet_rows(fullname, sheet2process, cols2hash, chunksize):
+    """ Stream the fields/columns selected for hashing from a sheet in fixed-size chunks of rows, using openpyxl's
+        read-only mode so that only the current chunk is held in memory. Formula cells are read as the value Excel
+        last calculated for them, not as the formula. The first row holds the column names and is skipped.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet selected by user to be processed.
+    :param cols2hash: Zero-based column indexes of the fields/columns selected for processing within the sheet.
+    :param chunksize: Maximum number of rows per chunk.
+    :return: Generator of lists of row tuples holding the values of cols2hash
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(fullname, read_only=True, keep_vba=False, data_only=True)
+    try:
+        sheet = workbook[sheet2process]
+        rows = []
+        for row in sheet.iter_rows(min_row=2, max_col=max(cols2hash) + 1, values_only=True):
+            rows.append(tuple(row[col] if col < len(row) else None for col in cols2hash))
+            if len(rows) == chunksize:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+    finally:
+        workbook.close()
+
+
+def read_sheet_text_rows(fullname, sheet2process, cols2hash, chunksize):
+    """ Stream the fields/columns selected for hashing from a sheet as text, straight from the sheet's XML, in
+        fixed-size chunks of rows. Every cell is read as the text the workbook records for it, without inferring
+        its type: a number is read as written, e.g. '123' or '1.5', a date as its serial number and a boolean as
+        'TRUE' or 'FALSE'. The first row holds the column names and is skipped.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet selected by user to be processed.
+    :param cols2hash: Zero-based column indexes of the fields/columns selected for processing within the sheet.
+    :param chunksize: Maximum number of rows per chunk.
+    :return: Generator of lists of row tuples holding the text (or None for empty cells) of cols2hash
+    """
+    probe = probe_workbook(fullname)
+    positions = dict((col, position) for position, col in enumerate(cols2hash))
+    empty = (None,) * len(cols2hash)
+    rows = []
+    row = list(empty)
+    column = rownumber = lastrow = 0
+    sheetdata = None
+    with zipfile.ZipFile(fullname) as archive, archive.open(probe.sheets[sheet2process]) as sheetfile, \
+            SharedStrings(archive, probe.sharedstrings) as sharedstrings:
+        for event, element in ElementTree.iterparse(sheetfile, events=('start', 'end')):
+            tag = local_name(element.tag)
+            if event == 'start':
+                if tag == 'sheetData':
+                    sheetdata = element
+                continue
+            if tag == 'c':
+                reference = element.get('r')
+                if reference:
+                    column = column_index(reference)
+                position = positions.get(column)
+                column += 1
+                if position is None:
+                    continue
+                celltype = element.get('t', 'n')
+                texts = [child.text or '' for child in element.iter()
+                         if local_name(child.tag) == ('t' if celltype == 'inlineStr' else 'v')]
+                if not texts:
+                    continue
+                value = ''.join(texts)
+                if celltype == 's':
+                    value = sharedstrings.lookup(int(value))
+                elif celltype == 'b':
+                    value = 'TRUE' if value == '1' else 'FALSE'
+                row[position] = value
+            elif tag == 'row':
+                rownumber = int(element.get('r') or rownumber + 1)
+                # Detach the parsed row, so that memory use does not grow with the length of the sheet
+                element.clear()
+                if sheetdata is not None:
+                    sheetdata.remove(element)
+                # Rows missing from the XML are empty, as openpyxl reads them
+                while lastrow < rownumber - 1:
+                    lastrow += 1
+                    if lastrow > 1:
+                        rows.append(empty)
+                        if len(rows) == chunksize:
+                            yield rows
+                            rows = []
+                if rownumber > 1:
+                    rows.append(tuple(row))
+                    if len(rows) == chunksize:
+                        yield rows
+                        rows = []
+                lastrow = rownumber
+                row = list(empty)
+                column = 0
+    if rows:
+        yield rows
+
+
+def stored_value(value):
+    """ The value a field/column value is stored as in the temporary database. Values sqlite3 cannot bind, such as
+        the datetime.time and datetime.timedelta values of time-formatted cells, are stored as the text they are
+        hashed as, see ExcelCryptoHash.hash_columns.
+
+    :param value: Value read from a cell, or None
+    :return: The value itself when sqlite3 can bind it, otherwise its text
+    """
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    return str(value)
+
+
+def normalize_values(values, rules):
+    """ Normalize the values of a field/column before hashing, so that e.g. '  123-45-6789' and '123456789' hash
+        alike. Every rule is applied to the whole column at once, in the order given. Values are converted to text
+        first; missing values stay missing.
+
+    :param values: Values of the field/column, e.g. a pandas Series
+    :param rules: List of normalization rules, see normalization_rules and parse_normalization
+    :return: pandas Series of the normalized values
+    """
+    import pandas as pd
+
+    values = pd.Series(values, dtype=object)
+    present = values.notna()
+    texts = values[present].astype(str)
+    for rule in rules:
+        name, _, argument = rule.partition(':')
+        if name == 'trim':
+            texts = texts.str.strip()
+        elif name == 'casefold':
+            texts = texts.str.casefold()
+        elif name == 'zfill':
+            texts = texts.str.zfill(int(argument))
+        elif name == 'punct':
+            texts = texts.str.replace('[' + re.escape(string.punctuation) + ']', '', regex=True)
+    values[present] = texts
+    return values
+
+
+def parse_normalization(text):
+    """ Parse a comma-separated list of normalization rules, e.g. 'trim,zfill:9'.
+
+    :param text: Rules, see normalization_rules
+    :return: List of rules
+    """
+    rules = [rule.strip().lower() for rule in text.split(',') if rule.strip()]
+    for rule in rules:
+        name, _, argument = rule.partition(':')
+        if name not in normalization_rules:
+            raise ValueError('Unknown normalization rule: ' + rule)
+        if (name == 'zfill') != argument.isdigit():
+            raise ValueError('Invalid normalization rule: ' + rule)
+    return rules
+
+
+def read_sheet_chunks(fullname, sheet2process, fields2hash, cols2hash, chunksize):
+    """ Stream the fields/columns selected for hashing from a sheet as DataFrames, see read_sheet_rows.
+
+    :param fullname: Path of the Excel input file
+    :param sheet2process: Sheet selected by user to be processed.
+    :param fields2hash: Names of the fields/columns selected for processing.
+    :param cols2hash: Zero-based column indexes of fields2hash within the sheet.
+    :param chunksize: Maximum number of rows per chunk.
+    :return: Generator of DataFrames with one column per field in fields2hash. Cell values keep the type
+             openpyxl reads them as (object dtype), so a field is converted the same way in every chunk.
+    """
+    import pandas as pd
+
+    for rows in read_sheet_rows(fullname, sheet2process, cols2hash, chunksize):
+        yield pd.DataFrame(rows, columns=fields2hash, dtype=object)
+
+
+def prefetch(iterable, depth):
+    """ Iterate over an iterable in a background thread that keeps at most depth items ready ahead of the consumer,
+        so that producing the next items (e.g. parsing the next chunk of rows) overlaps with consuming the current
+        one while memory stays bounded. Exceptions raised by the iterable are raised to the consumer.
+
+    :param iterable: Items to be produced. A generator is closed in the background thread once done.
+    :param depth: Maximum number of items buffered
+    :return: Generator of the items of iterable
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Give up once the consumer has stopped, so the thread never blocks on a full buffer forever
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
         try:
-            return sys.intern(str(s))
-        except UnicodeEncodeError:
-            # Fall through and handle s as Unicode
-            pass
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except Exception as e:
+            put((finished, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def file_fingerprint(fullname):
+    """ Fingerprint the contents of a file.
+
+    :param fullname: Path of the file
+    :return: SHA-256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(fullname, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_fingerprint(rows):
+    """ Fingerprint a chunk of rows read by read_sheet_rows. Cell values are fingerprinted with their type, so that
+        e.g. the number 7 and the text '007' differ.
+
+    :param rows: List of row tuples
+    :return: SHA-256 hex digest of the rows
+    """
+    return hashlib.sha256(repr(rows).encode('utf-8')).hexdigest()
+
+
+class CsvMapfileWriter(object):
+    """
+    Write a mapfile as gzip compressed CSV, one chunk of rows at a time.
+    """
+
+    extension = '.csv.gz'
+    binary = False
+
+    def __init__(self, filename, columns):
+        self.file = gzip.open(filename, 'wt', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetMapfileWriter(object):
+    """
+    Write a mapfile as Parquet with one row group per chunk of rows. ColumnName is dictionary encoded, Plaintext holds
+    the text that was hashed and Hashvalue the binary digest. Requires pyarrow.
+    """
+
+    extension = '.parquet'
+    # Hash values are written as binary digests, not as encoded text
+    binary = True
+
+    def __init__(self, filename, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        types = {'ColumnName': pa.dictionary(pa.int32(), pa.string()), 'Plaintext': pa.string(),
+                 'Hashvalue': pa.binary()}
+        self.schema = pa.schema([(column, types[column]) for column in columns])
+        self.writer = pq.ParquetWriter(filename, self.schema)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        pa = self.pa
+        arrays = []
+        for column, values in zip(self.schema.names, zip(*rows)):
+            if column == 'ColumnName':
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            elif column == 'Plaintext':
+                arrays.append(pa.array([str(value) for value in values], pa.string()))
+            else:
+                arrays.append(pa.array(values, pa.binary()))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# Writers for the mapfile output formats other than Excel, by format name.
+mapfile_writers = {'csv.gz': CsvMapfileWriter, 'parquet': ParquetMapfileWriter}
+
+
+class RunStatistics(object):
+    """
+    Counters and timings for the stages of a run: rows read, values hashed, rows stored and rows written, bytes and
+    elapsed time. Every update is passed on to an optional progress callback, callback(stage, progress), where
+    progress is the dictionary returned by 'progress'.
+    """
+
+    stagenames = ('read', 'hash', 'store', 'summary', 'detail', 'output')
+
+    # Share of the overall progress of the stages whose expected number of rows is known up front. Hashing and
+    # storing keep pace with reading.
+    weights = {'read': 0.5, 'summary': 0.1, 'detail': 0.1, 'output': 0.3}
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        # Stages may report from different threads when pipelined, see ExcelCryptoHash.pipelined
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = OrderedDict((stage, {'rows': 0, 'bytes': 0, 'elapsed': 0.0, 'expected': None})
+                                  for stage in self.stagenames)
+
+    def expect(self, stage, rows):
+        """ Record the number of rows a stage is expected to process, so that overall progress can be estimated.
+
+        :param stage: Name of the stage
+        :param rows: Expected number of rows, or None if unknown
+        """
+        self.stages[stage]['expected'] = rows
+
+    def add(self, stage, rows=0, nbytes=0, elapsed=0.0):
+        """ Add to the counters of a stage and report progress.
+
+        :param stage: Name of the stage
+        :param rows: Number of rows read, values hashed or rows stored/written
+        :param nbytes: Number of bytes read or written
+        :param elapsed: Seconds spent
+        """
+        with self.lock:
+            counters = self.stages[stage]
+            counters['rows'] += rows
+            counters['bytes'] += nbytes
+            counters['elapsed'] += elapsed
+            progress = self.progress(stage)
+        if self.callback is not None:
+            self.callback(stage, progress)
+
+    def progress(self, stage):
+        """ Progress of a stage.
+
+        :param stage: Name of the stage
+        :return: Dictionary with the stage name, rows, bytes, elapsed seconds, rows per second and the estimated
+                 overall percentage complete
+        """
+        counters = self.stages[stage]
+        return {'stage': stage, 'rows': counters['rows'], 'bytes': counters['bytes'], 'elapsed': counters['elapsed'],
+                'rows_per_sec': counters['rows'] / counters['elapsed'] if counters['elapsed'] else 0.0,
+                'percent': self.percent_complete()}
+
+    def percent_complete(self):
+        done = 0.0
+        for stage, weight in self.weights.items():
+            expected = self.stages[stage]['expected']
+            if expected:
+                done += weight * min(1.0, float(self.stages[stage]['rows']) / expected)
+        return 100.0 * done
 
-        # Look up the unicode value in the map and return
-        # the object from the map. If there is no matching entry,
-        # store this unicode object in the map and return it.
-        t = self.unicode_map.get(s, None)
-        if t is None:
-            # Put s in the map
-            t = self.unicode_map[s] = s
-        return t
+    def report(self):
+        """ Totals of the run.
+
+        :return: Dictionary with the start time, total elapsed seconds and the progress of every stage
+        """
+        stages = OrderedDict()
+        for stage in self.stagenames:
+            stages[stage] = self.progress(stage)
+            del stages[stage]['stage'], stages[stage]['percent']
+        return OrderedDict((('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+                            ('elapsed', time.time() - self.started), ('stages', stages)))
 
 
-def string_folding_wrapper(results):
+class DigestCache(object):
     """
-    This generator yields rows from the results as tuples,
-    with all string values folded.
+    Persistent cache of plaintext to hash value mappings kept in a local SQLite file, so that values hashed by an
+    earlier run are not hashed again. Entries are kept per namespace (the hash format, plus the key should keyed
+    hashing be used). Once the cache holds more than maxentries entries, those used longest ago are evicted.
     """
-    # Get the list of keys so that we build tuples with all
-    # the values in key order.
-    keys = list(results.keys())
-    folder = StringFolder()
-    for row in results:
-        yield tuple(
-            folder.fold_string(row[key])
-            for key in keys
-        )
+
+    def __init__(self, filename, maxentries=10000000):
+        self.filename = filename
+        self.maxentries = maxentries
+        self.hits = 0
+        self.misses = 0
+        # Used from the hashing thread when pipelined, never from two threads at once
+        self.connection = sqlite3.connect(filename, timeout=300, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS digests (Namespace TEXT, Plaintext TEXT, Hashvalue BLOB, '
+                                'LastUsed INTEGER, PRIMARY KEY (Namespace, Plaintext)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS digests_lastused ON digests (LastUsed)')
+        self.connection.execute('CREATE TEMP TABLE lookup (Plaintext TEXT PRIMARY KEY)')
+        # Every run gets a new generation number; eviction removes the entries of the oldest generations first.
+        self.generation = self.connection.execute('SELECT COALESCE(MAX(LastUsed), 0) + 1 FROM digests').fetchone()[0]
+        self.connection.commit()
+
+    def lookup(self, namespace, texts):
+        """ Look up the hash values of many plaintext values with a single indexed join.
+
+        :param namespace: Hash format (and key) the hash values were created with
+        :param texts: List of plaintext values, as text
+        :return: Dictionary of plaintext to binary digest for the values found in the cache
+        """
+        connection = self.connection
+        connection.executemany('INSERT OR IGNORE INTO temp.lookup VALUES (?)', ((text,) for text in texts))
+        found = dict(connection.execute('SELECT d.Plaintext, d.Hashvalue FROM temp.lookup l JOIN digests d '
+                                        'ON d.Namespace = ? AND d.Plaintext = l.Plaintext', (namespace,)))
+        if found:
+            connection.execute('UPDATE digests SET LastUsed = ? WHERE Namespace = ? AND Plaintext IN '
+                               '(SELECT Plaintext FROM temp.lookup)', (self.generation, namespace))
+        connection.execute('DELETE FROM temp.lookup')
+        connection.commit()
+        self.hits += len(found)
+        self.misses += len(set(texts)) - len(found)
+        return found
+
+    def store(self, namespace, texts, hashvalues):
+        """ Add newly hashed values to the cache.
+
+        :param namespace: Hash format (and key) the hash values were created with
+        :param texts: List of plaintext values, as text
+        :param hashvalues: List of binary digests in the same order as texts
+        """
+        self.connection.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                                    ((namespace, text, hashvalue, self.generation)
+                                     for text, hashvalue in zip(texts, hashvalues)))
+        self.connection.commit()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache holds no more than maxentries entries.
+
+        :return: Number of entries removed
+        """
+        excess = self.connection.execute('SELECT COUNT(*) FROM digests').fetchone()[0] - self.maxentries
+        if excess <= 0:
+            return 0
+        self.connection.execute('DELETE FROM digests WHERE (Namespace, Plaintext) IN '
+                                '(SELECT Namespace, Plaintext FROM digests ORDER BY LastUsed LIMIT ?)', (excess,))
+        self.connection.commit()
+        return excess
+
+    def statistics(self):
+        """ Hit/miss statistics of this run.
+
+        :return: Dictionary with the number of hits, misses and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+class LookupStore(object):
+    """
+    Persistent reverse-lookup store resolving hash values back to the plaintext values they were created from. The
+    mappings are kept in a local SQLite file keyed by the binary digest, so that resolving a hash value is an index
+    lookup rather than a scan of the mapfiles. Several runs, hash formats and fields/columns may share one store.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=300)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS mappings (Hashvalue BLOB, HashFormat TEXT, '
+                                'ColumnName TEXT, Plaintext, PRIMARY KEY (Hashvalue, HashFormat, ColumnName)) '
+                                'WITHOUT ROWID')
+        self.connection.execute('CREATE TEMP TABLE resolve (Hashvalue BLOB PRIMARY KEY)')
+        self.connection.commit()
+
+    def add(self, hstr, rows):
+        """ Add mappings to the store, replacing those of the same hash value, hash format and field/column.
+
+        :param hstr: Hash format the hash values were created with
+        :param rows: Iterable of (field/column name, plaintext, binary digest) tuples
+        :return: Number of mappings added
+        """
+        cursor = self.connection.executemany('INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?)',
+                                             ((hashvalue, hstr, columnname, plaintext)
+                                              for columnname, plaintext, hashvalue in rows))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def resolve(self, hashvalues, hstr=None):
+        """ Resolve many hash values with a single indexed join.
+
+        :param hashvalues: Hash values as hex or base64 text, see decode_digest
+        :param hstr: Only resolve hash values of this hash format (default: any)
+        :return: Dictionary of every hash value given to a list of (hash format, field/column name, plaintext)
+                 tuples; the list is empty for hash values not in the store. Hash values that are neither valid
+                 hex nor valid base64 are left unresolved.
+        """
+        digests = OrderedDict((hashvalue, decode_digest(hashvalue)) for hashvalue in hashvalues)
+        connection = self.connection
+        connection.executemany('INSERT OR IGNORE INTO temp.resolve VALUES (?)',
+                               ((digest,) for digest in digests.values() if digest is not None))
+        found = {}
+        for digest, hashformat, columnname, plaintext in connection.execute(
+                'SELECT m.Hashvalue, m.HashFormat, m.ColumnName, m.Plaintext FROM temp.resolve r JOIN mappings m '
+                'ON m.Hashvalue = r.Hashvalue WHERE ? IS NULL OR m.HashFormat = ? '
+                'ORDER BY m.Hashvalue, m.HashFormat, m.ColumnName', (hstr, hstr)):
+            found.setdefault(digest, []).append((hashformat, columnname, plaintext))
+        connection.execute('DELETE FROM temp.resolve')
+        connection.commit()
+        return OrderedDict((hashvalue, found.get(digest, [])) for hashvalue, digest in digests.items())
+
+    def statistics(self):
+        """ Number of mappings in the store.
+
+        :return: Dictionary of hash format to number of mappings
+        """
+        return dict(self.connection.execute('SELECT HashFormat, COUNT(*) FROM mappings GROUP BY HashFormat'))
+
+    def close(self):
+        self.connection.close()
 
 
 class ExcelCryptoHash(object):
@@ -103,21 +1352,480 @@ class ExcelCryptoHash(object):
 
     def __init__(self):
         self.hstr = 'sha512'
-        self.h = SHA512.new()
+        # All hash formats computed by a run, see identify_hashes, and the column holding the hash values of the
+        # format currently written, see select_hash
+        self.hstrs = ['sha512']
+        self.hashcolumn = 'Hashvalue'
+        self.digestencoding = 'hex'
+        # Constructor of the per-value hash objects of hash_text. Created on first use, so that selecting a hash
+        # format never imports pycryptodome, see hash_constructor.
+        self.h = None
         self.files2process = []
         self.fields2encrypt = []
         self.fields2process = []
         self.inputdirectory = ''
         self.outputdirectory = ''
+        self.parallel = False
+        self.workers = os.cpu_count() or 1
+        self.chunksize = 100000
+        self.dbname = None
+        self.tempdirectory = None
+        self.inmemorylimit = 64 * 1024 * 1024
+        self.outputformat = 'xlsx'
+        self.progress_callback = None
+        self.statistics = RunStatistics()
+        self.digestcache = None
+        self.statefile = None
+        # Read, hash and store chunks concurrently, with at most pipelinedepth chunks in flight between stages
+        self.pipelined = False
+        self.pipelinedepth = 2
+        # Cancellation token, checked between chunks and stages. May be replaced by the caller's own Event.
+        self.cancelled = threading.Event()
+        # Mappings beyond this many rows per sheet (including the header row) roll over to numbered sheets
+        self.maxsheetrows = excel_max_rows
+        self.layout = None
+        # Number of worker processes writing the mapfiles and Hashed_ copies concurrently, see write_outputs
+        self.outputworkers = 1
+        # Read the selected fields/columns as text (see read_sheet_text_rows) and normalize the values of the
+        # fields/columns in normalization, a dictionary of field/column name to rules (see normalize_values)
+        self.textinput = False
+        self.normalization = {}
+        # Write the hash values in place of the plaintext values in the Hashed_ copy, see write_hashed_outputfile
+        self.replacevalues = False
 
-    def initialize_sqlite(self):
-        self.SQLiteconnection = sa.create_engine('sqlite:///itellihashexcel.db')
+    def initialize_sqlite(self, dbname=None, inputsize=None):
+        """ Create the temporary SQLite database used to store, sort and de-duplicate the hashed values. Every job
+            gets its own database: in memory when the input is small enough, otherwise a temporary file. A unique
+            index on (ColumnName, Plaintext) serves the sorted mapfile queries and drops duplicate values at insert
+            time. When self.statefile is set, that file is used and kept: it also records the fingerprints of the
+            input chunks, so that a rerun only processes the chunks that changed (see create_combined_temp_db).
 
-    @staticmethod
-    def remove_sqlite():
-        os.remove("itellihashexcel.db")
+        :param dbname: Database file to use. self.statefile, or else a new temporary file in self.tempdirectory,
+                       is used when not given.
+        :param inputsize: Size in bytes of the input file(s). The database is kept in memory when it is at most
+                          self.inmemorylimit.
+        :return: No explicit value returned. self.SQLiteconnection is set for further processing.
+        """
+        import sqlalchemy as sa
+
+        self.statistics = RunStatistics(self.progress_callback)
+        if dbname is None and self.statefile is not None:
+            dbname = self.statefile
+        elif dbname is None and inputsize is not None and inputsize <= self.inmemorylimit:
+            dbname = ':memory:'
+        elif dbname is None:
+            dbhandle, dbname = tempfile.mkstemp(prefix='itellihashexcel_', suffix='.db', dir=self.tempdirectory)
+            os.close(dbhandle)
+        self.connect_sqlite(dbname, state_pragmas if dbname == self.statefile else scratch_pragmas)
+
+        with self.SQLiteconnection.begin() as connection:
+            connection.execute(sa.text('CREATE TABLE IF NOT EXISTS data '
+                                       '(ColumnName TEXT NOT NULL, Plaintext, Hashvalue BLOB)'))
+            connection.execute(sa.text('CREATE UNIQUE INDEX IF NOT EXISTS data_columnname_plaintext '
+                                       'ON data (ColumnName, Plaintext)'))
+            if dbname == self.statefile:
+                # Fingerprints of the inputs and of every chunk of rows read from them, and the distinct values of
+                # every chunk, so that the mappings of a changed or removed chunk can be pruned
+                connection.execute(sa.text('CREATE TABLE IF NOT EXISTS settings (Name TEXT PRIMARY KEY, Value TEXT)'))
+                connection.execute(sa.text('CREATE TABLE IF NOT EXISTS inputs (Source TEXT, Sheet TEXT, '
+                                           'Fingerprint TEXT, Chunks INTEGER, PRIMARY KEY (Source, Sheet))'))
+                connection.execute(sa.text('CREATE TABLE IF NOT EXISTS chunks (ChunkId INTEGER PRIMARY KEY, '
+                                           'Source TEXT, Sheet TEXT, ChunkIndex INTEGER, Rows INTEGER, '
+                                           'Fingerprint TEXT, UNIQUE (Source, Sheet, ChunkIndex))'))
+                connection.execute(sa.text('CREATE TABLE IF NOT EXISTS chunkvalues '
+                                           '(ChunkId INTEGER, ColumnName TEXT, Plaintext)'))
+                connection.execute(sa.text('CREATE INDEX IF NOT EXISTS chunkvalues_chunkid ON chunkvalues (ChunkId)'))
+                connection.execute(sa.text('CREATE INDEX IF NOT EXISTS chunkvalues_columnname_plaintext '
+                                           'ON chunkvalues (ColumnName, Plaintext)'))
+
+    def connect_sqlite(self, dbname, pragmas):
+        """ Connect to the temporary database, see initialize_sqlite.
+
+        :param dbname: Database file, or ':memory:'
+        :param pragmas: SQLite pragmas applied to every connection
+        :return: No explicit value returned. self.dbname and self.SQLiteconnection are set for further processing.
+        """
+        import sqlalchemy as sa
+
+        self.dbname = dbname
+        if dbname == ':memory:':
+            # A single shared connection, as every new connection would get an empty database of its own
+            self.SQLiteconnection = sa.create_engine('sqlite://', poolclass=sa.pool.StaticPool,
+                                                     connect_args={'check_same_thread': False})
+        else:
+            self.SQLiteconnection = sa.create_engine('sqlite:///' + dbname)
+
+        @sa.event.listens_for(self.SQLiteconnection, 'connect')
+        def tune_sqlite(dbapi_connection, connection_record):
+            for pragma in pragmas:
+                dbapi_connection.execute(pragma)
+            dbapi_connection.create_function('base64', 1, encode_base64)
+
+    def remove_sqlite(self, removestate=False):
+        """ Close the temporary database and remove its file. A state file is kept unless removestate is set.
+
+        :param removestate: Also remove self.statefile, e.g. a checkpoint that is no longer needed once a run
+                            completed
+        """
+        self.SQLiteconnection.dispose()
+        if self.dbname != ':memory:' and (self.dbname != self.statefile or removestate):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.dbname + suffix):
+                    os.remove(self.dbname + suffix)
         gc.collect()
 
+    def cancel(self):
+        """ Ask a run in progress, e.g. on another thread, to stop at the next chunk or stage boundary, see
+            check_cancelled.
+        """
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        """ Stop processing when cancel has been called.
+
+        :return: No explicit value returned. OperationCancelled is raised when the run was cancelled.
+        """
+        if self.cancelled.is_set():
+            raise OperationCancelled('Processing cancelled')
+
+    def store_hashes(self, field, plaintexts, hashvalues):
+        """ Bulk insert the hashed values of a field/column into the temporary database. Values already stored,
+            e.g. from an earlier chunk, are dropped by the unique index.
+
+        :param field: Field/column name
+        :param plaintexts: Original values
+        :param hashvalues: Hashed values in the same order as plaintexts. Tuples of hashed values, in the order of
+                           self.hstrs, when several hash formats are computed.
+        :return: Number of values stored
+        """
+        if len(self.hstrs) > 1:
+            columns = [self.hash_column(hstr) for hstr in self.hstrs]
+            rows = ((field, plaintext) + hashvalue for plaintext, hashvalue in zip(plaintexts, hashvalues))
+        else:
+            columns = ['Hashvalue']
+            rows = zip(repeat(field), plaintexts, hashvalues)
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.executemany('INSERT OR IGNORE INTO data (ColumnName, Plaintext, ' + ', '.join(columns) +
+                               ') VALUES (?, ?' + ', ?' * len(columns) + ')', rows)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            connection.close()
+
+    def add_hash_columns(self):
+        """ Add a Hashvalue_<hash format> column to the temporary database for every hash format computed besides
+            the first, see identify_hashes.
+        """
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            existing = set(row[1] for row in cursor.execute('PRAGMA table_info(data)'))
+            for hstr in self.hstrs:
+                if self.hash_column(hstr) not in existing:
+                    cursor.execute('ALTER TABLE data ADD COLUMN ' + self.hash_column(hstr) + ' BLOB')
+            connection.commit()
+        finally:
+            connection.close()
+
+    def unstored_values(self, field, plaintexts):
+        """ Find the values of a field/column that are not in the temporary database yet, e.g. because they were
+            already stored from an earlier chunk, sheet or file, so that every distinct value is hashed only once.
+
+        :param field: Field/column name
+        :param plaintexts: Distinct original values
+        :return: List of the values in plaintexts not yet stored for field
+        """
+        if not plaintexts:
+            return []
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (Plaintext)')
+            cursor.executemany('INSERT INTO temp.candidates VALUES (?)', ((plaintext,) for plaintext in plaintexts))
+            cursor.execute('SELECT c.Plaintext FROM temp.candidates c WHERE NOT EXISTS (SELECT 1 FROM data d '
+                           'WHERE d.ColumnName = ? AND d.Plaintext = c.Plaintext)', (field,))
+            unstored = [row[0] for row in cursor]
+            cursor.execute('DELETE FROM temp.candidates')
+            connection.commit()
+            return unstored
+        finally:
+            connection.close()
+
+    def count_hashes(self):
+        """ Count the hashed values in the temporary database.
+
+        :return: Number of rows in the data table
+        """
+        return next(self.iterate_query('SELECT COUNT(*) FROM data'))[0]
+
+    def count_hashes_by_column(self):
+        """ Count the hashed values of every field/column in the temporary database.
+
+        :return: Dictionary of field/column name to number of hashed values
+        """
+        return dict(self.iterate_query('SELECT ColumnName, COUNT(*) FROM data GROUP BY ColumnName'))
+
+    def estimate_layout(self, sources, fields2hash):
+        """ Estimate up front, from the dimensions recorded in the input workbooks, how many sheets the Excel
+            mapfiles will need, see ShardedWorksheet. Every row is assumed to hold distinct values, so the estimate
+            is an upper bound.
+
+        :param sources: List of (Excel input file path, sheet name) pairs to be processed.
+        :param fields2hash: Fields/columns selected for processing.
+        :return: Dictionary with the estimated number of rows and the number of summary sheets and of detail sheets
+                 per field/column, or None when a workbook does not record its dimension.
+        """
+        rows = 0
+        for fullname, sheet2process in sources:
+            estimate = estimate_sheet_rows(fullname, sheet2process)
+            if estimate is None:
+                return None
+            rows += estimate
+        return OrderedDict((('rows', rows), ('maxsheetrows', self.maxsheetrows),
+                            ('summarysheets', shard_count(rows * len(fields2hash), self.maxsheetrows)),
+                            ('detailsheets', shard_count(rows, self.maxsheetrows))))
+
+    def reset_fingerprints(self, fields2hash):
+        """ Discard the mappings and fingerprints kept in the state file when they were recorded with another hash
+            format, other fields/columns, another chunk size or other text input and normalization settings.
+
+        :param fields2hash: Fields/columns selected for processing
+        :return: True when the state file was reset
+        """
+        settings = json.dumps([self.hstrs if len(self.hstrs) > 1 else self.hstr, list(fields2hash), self.chunksize,
+                               self.textinput, sorted(self.normalization.items())])
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT Value FROM settings WHERE Name = 'run'")
+            recorded = cursor.fetchone()
+            if recorded is not None and recorded[0] == settings:
+                return False
+            for table in ('data', 'inputs', 'chunks', 'chunkvalues'):
+                cursor.execute('DELETE FROM ' + table)
+            cursor.execute("INSERT OR REPLACE INTO settings VALUES ('run', ?)", (settings,))
+            connection.commit()
+            return True
+        finally:
+            connection.close()
+
+    def output_settings(self, **details):
+        """ Describe the settings that shape the output files, as opposed to the mappings, so that an incremental
+            run can tell whether the outputs of the previous run over the same state file are still what is asked
+            for, see recorded_output_settings.
+
+        :param details: Further settings of the caller, e.g. whether a Hashed_ copy is written
+        :return: Settings as JSON text
+        """
+        settings = dict(details, outputformat=self.outputformat, digestencoding=self.digestencoding,
+                        maxsheetrows=self.maxsheetrows, replacevalues=self.replacevalues)
+        return json.dumps(settings, sort_keys=True)
+
+    def recorded_output_settings(self):
+        """ Look up the output settings recorded in the state file by record_output_settings.
+
+        :return: Settings as JSON text, or None when no outputs were recorded
+        """
+        recorded = self.iterate_query("SELECT Value FROM settings WHERE Name = 'outputs'")
+        settings = next(recorded, (None,))[0]
+        recorded.close()
+        return settings
+
+    def record_output_settings(self, settings):
+        """ Record the settings the outputs were written with in the state file, once they are all written.
+
+        :param settings: Settings from output_settings, or None to forget the recorded settings before the state
+                         file or the outputs change, so that a run that fails part way never counts as written
+        """
+        import sqlalchemy as sa
+
+        with self.SQLiteconnection.begin() as connection:
+            if settings is None:
+                connection.execute(sa.text("DELETE FROM settings WHERE Name = 'outputs'"))
+            else:
+                connection.execute(sa.text("INSERT OR REPLACE INTO settings VALUES ('outputs', :settings)"),
+                                   {'settings': settings})
+
+    def recorded_fingerprints(self, fullname, sheet2process):
+        """ Look up the fingerprints recorded in the state file for a sheet.
+
+        :param fullname: Path of the Excel input file
+        :param sheet2process: Sheet to look up
+        :return: Tuple of the file fingerprint (None when the sheet was not recorded yet) and a dictionary of
+                 chunk index to a (rows, chunk fingerprint) tuple
+        """
+        recorded = self.iterate_query('SELECT Fingerprint FROM inputs WHERE Source = ? AND Sheet = ?',
+                                      (fullname, sheet2process))
+        fingerprint = next(recorded, (None,))[0]
+        recorded.close()
+        chunks = dict((chunkindex, (rows, chunkprint)) for chunkindex, rows, chunkprint in self.iterate_query(
+            'SELECT ChunkIndex, Rows, Fingerprint FROM chunks WHERE Source = ? AND Sheet = ?',
+            (fullname, sheet2process)))
+        return fingerprint, chunks
+
+    def record_input(self, fullname, sheet2process, fingerprint, chunks):
+        """ Record the fingerprint of an input file in the state file once all chunks of a sheet are recorded.
+
+        :param fullname: Path of the Excel input file
+        :param sheet2process: Sheet processed
+        :param fingerprint: Fingerprint of the file, see file_fingerprint
+        :param chunks: Number of chunks read from the sheet
+        """
+        import sqlalchemy as sa
+
+        with self.SQLiteconnection.begin() as connection:
+            connection.execute(sa.text('INSERT OR REPLACE INTO inputs VALUES (:source, :sheet, :fingerprint, :chunks)'),
+                               {'source': fullname, 'sheet': sheet2process, 'fingerprint': fingerprint,
+                                'chunks': chunks})
+
+    def record_chunk(self, fullname, sheet2process, chunkindex, rows, fingerprint, fields2hash, distinct):
+        """ Record the fingerprint and the distinct values of a chunk of rows in the state file, replacing those of
+            an earlier version of the chunk.
+
+        :param fullname: Path of the Excel input file
+        :param sheet2process: Sheet the chunk was read from
+        :param chunkindex: Zero-based position of the chunk within the sheet
+        :param rows: Number of rows in the chunk
+        :param fingerprint: Fingerprint of the chunk, see chunk_fingerprint
+        :param fields2hash: Fields/columns selected for processing
+        :param distinct: List with the distinct values of every field in fields2hash
+        """
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('DELETE FROM chunkvalues WHERE ChunkId IN (SELECT ChunkId FROM chunks '
+                           'WHERE Source = ? AND Sheet = ? AND ChunkIndex = ?)', (fullname, sheet2process, chunkindex))
+            cursor.execute('INSERT OR REPLACE INTO chunks (Source, Sheet, ChunkIndex, Rows, Fingerprint) '
+                           'VALUES (?, ?, ?, ?, ?)', (fullname, sheet2process, chunkindex, rows, fingerprint))
+            chunkid = cursor.lastrowid
+            for field, values in zip(fields2hash, distinct):
+                cursor.executemany('INSERT INTO chunkvalues VALUES (?, ?, ?)',
+                                   zip(repeat(chunkid), repeat(field), values))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def prune_fingerprints(self, sources):
+        """ Remove the chunks of inputs that are no longer processed, or beyond the end of an input that shrank,
+            from the state file together with the mappings of values that no longer occur in any chunk.
+
+        :param sources: List of (Excel input file path, sheet name) pairs processed by this run
+        :return: Number of mappings removed
+        """
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS sources (Source TEXT, Sheet TEXT)')
+            cursor.execute('DELETE FROM temp.sources')
+            cursor.executemany('INSERT INTO temp.sources VALUES (?, ?)', sources)
+            cursor.execute('DELETE FROM inputs WHERE (Source, Sheet) NOT IN (SELECT Source, Sheet FROM temp.sources)')
+            cursor.execute('DELETE FROM chunks WHERE NOT EXISTS (SELECT 1 FROM inputs i WHERE i.Source = '
+                           'chunks.Source AND i.Sheet = chunks.Sheet AND chunks.ChunkIndex < i.Chunks)')
+            cursor.execute('DELETE FROM chunkvalues WHERE ChunkId NOT IN (SELECT ChunkId FROM chunks)')
+            cursor.execute('DELETE FROM data WHERE NOT EXISTS (SELECT 1 FROM chunkvalues v '
+                           'WHERE v.ColumnName = data.ColumnName AND v.Plaintext = data.Plaintext)')
+            pruned = cursor.rowcount
+            connection.commit()
+            return pruned
+        finally:
+            connection.close()
+
+    def iterate_query(self, statement, parameters=()):
+        """ Stream the rows of a query against the temporary database one at a time.
+
+        :param statement: SQL statement with qmark style parameters
+        :param parameters: Parameters of the statement
+        :return: Generator of row tuples
+        """
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(statement, parameters)
+            for row in cursor:
+                yield row
+        finally:
+            connection.close()
+
+    def iterate_query_chunks(self, statement, parameters=(), size=100000):
+        """ Stream the rows of a query against the temporary database in chunks.
+
+        :param statement: SQL statement with qmark style parameters
+        :param parameters: Parameters of the statement
+        :param size: Maximum number of rows per chunk
+        :return: Generator of lists of row tuples
+        """
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(statement, parameters)
+            rows = cursor.fetchmany(size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(size)
+        finally:
+            connection.close()
+
+    def open_digest_cache(self, filename, maxentries=10000000):
+        """ Consult (and fill) a persistent digest cache when hashing, so that only values not hashed by an
+            earlier run are hashed.
+
+        :param filename: Location of the cache file. It is created if it does not exist.
+        :param maxentries: Maximum number of entries kept in the cache
+        """
+        self.digestcache = DigestCache(filename, maxentries)
+
+    def close_digest_cache(self):
+        """ Evict surplus entries from and close the digest cache.
+
+        :return: Hit/miss statistics of the digest cache, or None when no cache was open.
+        """
+        if self.digestcache is None:
+            return None
+        statistics = self.digestcache.statistics()
+        self.digestcache.close()
+        self.digestcache = None
+        return statistics
+
+    def write_lookup_store(self, filename):
+        """ Add the mappings of every hash format computed to a persistent reverse-lookup store, see LookupStore.
+
+        :param filename: Location of the lookup store. It is created if it does not exist. Binary digests are
+                         stored, whatever self.digestencoding is.
+        :return: Number of mappings added
+        """
+        store = LookupStore(filename)
+        added = 0
+        try:
+            for hstr in (self.hstrs if len(self.hstrs) > 1 else [self.hstr]):
+                for rows in self.iterate_query_chunks('SELECT ColumnName, Plaintext, ' + self.hash_column(hstr) +
+                                                      ' FROM data', (), self.chunksize):
+                    added += store.add(hstr, rows)
+        finally:
+            store.close()
+        return added
+
+    def write_run_report(self, filename, **details):
+        """ Write a machine-readable JSON report of the run's statistics.
+
+        :param filename: Name of the report file
+        :param details: Further items to include in the report, e.g. the input file name
+        :return: The report written
+        """
+        report = OrderedDict((('hash', self.hstr), ('encoding', self.digestencoding)))
+        if len(self.hstrs) > 1:
+            report['hashes'] = list(self.hstrs)
+        report.update(sorted(details.items()))
+        if self.layout is not None:
+            report['layout'] = self.layout
+        report.update(self.statistics.report())
+        if self.digestcache is not None:
+            report['digest_cache'] = self.digestcache.statistics()
+        with open(filename, 'w') as reportfile:
+            json.dump(report, reportfile, indent=2)
+        return report
+
     def identify_hash(self, hash2use):
         """ Identify type of cryptographic hashing to use for processing.
 
@@ -125,21 +1833,59 @@ class ExcelCryptoHash(object):
         :return: No explicit value returned. Variables set for further processing.
 
         """
-        if hash2use == 1:
-            self.h = RIPEMD.new()
-            self.hstr = 'ripemd160'
-        elif hash2use == 2:
-            self.h = SHA224.new()
-            self.hstr = 'sha224'
-        elif hash2use == 3:
-            self.h = SHA256.new()
-            self.hstr = 'sha256'
-        elif hash2use == 4:
-            self.h = SHA384.new()
-            self.hstr = 'sha384'
-        elif hash2use == 5:
-            self.h = SHA512.new()
-            self.hstr = 'sha512'
+        if 1 <= hash2use <= len(hash_formats):
+            self.hstr = hash_formats[hash2use - 1]
+        self.h = None
+        self.hstrs = [self.hstr]
+        self.hashcolumn = 'Hashvalue'
+
+    def identify_hashes(self, hstrs):
+        """ Compute several hash formats in the same pass over the data: every distinct value is read,
+            de-duplicated and then hashed with all formats at once. The first format is the primary one, stored in
+            the Hashvalue column of the temporary database; the others get a Hashvalue_<hash format> column each.
+            Every format gets its own mapfiles, see process_hash_mapfiles.
+
+        :param hstrs: Names of the hash formats to compute, from hash_formats
+        :return: No explicit value returned. Variables set for further processing.
+        """
+        unknown = [hstr for hstr in hstrs if hstr not in hash_formats]
+        if unknown or not hstrs:
+            raise ValueError('Unknown hash format(s): ' + ', '.join(unknown))
+        self.identify_hash(hash_formats.index(hstrs[0]) + 1)
+        self.hstrs = list(OrderedDict.fromkeys(hstrs))
+
+    def hash_column(self, hstr):
+        """ Name of the column of the temporary database holding the hash values of a hash format.
+
+        :param hstr: Name of the hash format
+        :return: 'Hashvalue' for the primary hash format, otherwise 'Hashvalue_<hash format>'
+        """
+        if len(self.hstrs) > 1 and hstr != self.hstrs[0]:
+            return 'Hashvalue_' + hstr
+        return 'Hashvalue'
+
+    def hash_expression(self, binary=False):
+        """ SQL expression selecting the hash values of the hash format selected for writing, see select_hash.
+
+        :param binary: Select the binary digests rather than text encoded as self.digestencoding ('hex' or
+                       'base64')
+        :return: SQL expression
+        """
+        if binary:
+            return self.hashcolumn
+        if self.digestencoding not in digest_encodings:
+            raise ValueError('Unknown digest encoding: ' + str(self.digestencoding))
+        return digest_encodings[self.digestencoding].format(self.hashcolumn)
+
+    def select_hash(self, hstr):
+        """ Select the hash format whose hash values the mapfile and output writers write, and whose name they
+            put in the file names.
+
+        :param hstr: Name of one of the hash formats computed, see identify_hashes
+        """
+        self.hstr = hstr
+        self.hashcolumn = self.hash_column(hstr)
+        self.h = None
 
     def hash_text(self, desired_column):
         """ Hash individual fields/columns.
@@ -148,35 +1894,286 @@ class ExcelCryptoHash(object):
         :return: self.hashed_value: Hashed value of field/column processed
 
         """
-        h = self.h.new()
+        if self.h is None:
+            self.h = hash_constructor(self.hstr)
+        h = self.h()
         self.hashvalue = h.update(str.encode(str(desired_column)))
         self.hashed_value = h.hexdigest()
         return self.hashed_value
 
+    def create_hashing_pool(self):
+        """ Create the pool of worker processes used for hashing when parallel processing is enabled.
+
+        :return: ProcessPoolExecutor with self.workers processes, or None when hashing is done in-process.
+        """
+        if not self.parallel or self.workers <= 1:
+            return None
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def hash_columns(self, columns, executor=None):
+        """ Hash several fields/columns at once. When a digest cache is open, all values are first looked up
+            in the cache in bulk and only the values not found are hashed. With an executor, every column is split
+            into chunks and all chunks of all columns are fanned out across the worker processes before any
+            results are collected.
+
+        :param columns: List of arrays/Series, one for each field/column to be hashed
+        :param executor: Optional pool from create_hashing_pool
+        :return: List with a list of binary digests for each column, in the same order as columns
+        """
+        import numpy as np
+
+        if self.textinput:
+            # Values read as text need no conversion
+            texts = [list(values) for values in columns]
+        else:
+            texts = [np.asarray(values, dtype=object).astype(str).tolist() for values in columns]
+        if self.digestcache is None:
+            return self.hash_texts(texts, executor)
+
+        # Every hash format has its own namespace in the cache; a value counts as cached when found for all
+        multi = len(self.hstrs) > 1
+        hstrs = self.hstrs if multi else [self.hstr]
+        cached = []
+        for column in texts:
+            found = [self.digestcache.lookup(hstr, column) for hstr in hstrs]
+            if multi:
+                cached.append(dict((text, tuple(hashes[text] for hashes in found))
+                                   for text in set(found[0]).intersection(*found[1:])))
+            else:
+                cached.append(found[0])
+        misses = [list(set(column).difference(found)) for column, found in zip(texts, cached)]
+        for column, found, hashed in zip(misses, cached, self.hash_texts(misses, executor)):
+            for hstr, hashes in zip(hstrs, zip(*hashed) if multi else [hashed]):
+                self.digestcache.store(hstr, column, hashes)
+            found.update(zip(column, hashed))
+        return [[found[text] for text in column] for column, found in zip(texts, cached)]
+
+    def hash_texts(self, texts, executor=None):
+        """ Hash several fields/columns that have already been converted to text.
+
+        :param texts: List with a list of text values for each field/column to be hashed
+        :param executor: Optional pool from create_hashing_pool
+        :return: List with a list of binary digests for each column, in the same order as texts. When several hash
+                 formats are computed, every item is a tuple with one digest per format.
+        """
+        function, hstr = (hash_chunk_multi, tuple(self.hstrs)) if len(self.hstrs) > 1 else (hash_chunk, self.hstr)
+        if executor is None:
+            return [function(hstr, column) for column in texts]
+
+        total = sum(len(column) for column in texts)
+        size = max(1, min(self.chunksize, int(math.ceil(total / float(self.workers)))))
+        futures = [[executor.submit(function, hstr, column[i:i + size]) for i in range(0, len(column), size)]
+                   for column in texts]
+        return [[digest for future in column for digest in future.result()] for column in futures]
+
     def create_temp_db(self, fileselected, sheet2process, fields2hash, cols2hash, inputdirectory):
         """ Processing logic for hashing the file and fields/columns selected by the
             user for processing. This function creates an SQLite database that is used during the processing
             to store data, perform in-placed sorting and de-duplication, etc.
 
+            When a state file is used (self.statefile), a sheet whose file is unchanged since the previous run is
+            not read at all, and the chunks of rows whose fingerprints are unchanged are not hashed or stored again:
+            their mappings are already in the state file.
+
+            With self.pipelined, reading, hashing and storing run concurrently on consecutive chunks, see
+            prepare_chunks, hash_chunk_columns and store_chunk.
+
         :param inputdirectory: Location of Excel input file(s)
         :param sheet2process: Sheet selected by user to be processed.
         :param fields2hash: List containing the fields/columns selected for processing.
         :param cols2hash: Columns within sheet to be hashed.
-        :return: Temporary SQLite database used for subsequent processing.
+        :return: Number of chunks of rows hashed and stored. The temporary SQLite database is used for subsequent
+                 processing.
         """
         fullname = inputdirectory + fileselected
+        statistics = self.statistics
+        self.add_hash_columns()
+        incremental = self.statefile is not None and self.dbname == self.statefile
+        if incremental:
+            fingerprint = file_fingerprint(fullname)
+            recordedprint, recorded = self.recorded_fingerprints(fullname, sheet2process)
+            if fingerprint == recordedprint:
+                statistics.add('read', rows=sum(rows for rows, chunkprint in recorded.values()))
+                return 0
 
-        pdcomposite = pd.read_excel(fullname, sheet2process, index_col=None, parse_cols=cols2hash)
+        # Several sheets or files may be processed into the same temporary database, see create_combined_temp_db
+        estimate = estimate_sheet_rows(fullname, sheet2process)
+        if estimate is not None:
+            statistics.expect('read', (statistics.stages['read']['expected'] or 0) + estimate)
+        statistics.add('read', nbytes=os.path.getsize(fullname))
 
-        # Loop through selected fields, hash, and store them
-        for field in fields2hash:
-            self.compositefile = pdcomposite.loc[:, [field]]
-            self.compositefile.drop_duplicates(inplace=True)
-            self.compositefile["ColumnName"] = field
-            self.compositefile["Plaintext"] = self.compositefile[field]
-            self.compositefile["Hashvalue"] = self.compositefile.apply(lambda c: self.hash_text(c.loc[field]), axis=1)
-            self.compositefile.drop([field], inplace=True, axis=1)
-            self.compositefile.to_sql('data', self.SQLiteconnection, index=False, if_exists="append")
+        reader = read_sheet_text_rows if self.textinput else read_sheet_rows
+        chunks = self.prepare_chunks(reader(fullname, sheet2process, cols2hash, self.chunksize), fields2hash,
+                                     recorded if incremental else None)
+        depth = 0
+        hashingthread = None
+        if self.pipelined:
+            # Chunks are read and prepared in a background thread and hashed in another, while this thread filters
+            # and stores them. The bounded buffers apply backpressure, so memory stays capped.
+            depth = max(1, self.pipelinedepth)
+            chunks = prefetch(chunks, depth)
+            hashingthread = ThreadPoolExecutor(max_workers=1)
+        executor = self.create_hashing_pool()
+        inflight = deque()
+        # Values handed to the hashing stage but not stored yet, so that a later chunk does not hash them again
+        pending = dict((field, set()) for field in fields2hash)
+        chunkcount = processed = 0
+        try:
+            # Hash the distinct values of each chunk that are not stored yet as soon as the chunk has been read
+            # (fanned out across worker processes when parallel processing is enabled) and bulk insert them.
+            for chunkindex, rowcount, chunkprint, distinct in chunks:
+                if self.cancelled.is_set():
+                    # Store what is in flight first, so that a resumed run reuses it
+                    break
+                chunkcount = chunkindex + 1
+                if distinct is None:
+                    continue
+
+                started = time.perf_counter()
+                unstored = []
+                for field, values in zip(fields2hash, distinct):
+                    values = [value for value in self.unstored_values(field, values) if value not in pending[field]]
+                    pending[field].update(values)
+                    unstored.append(values)
+                statistics.add('hash', elapsed=time.perf_counter() - started)
+                if hashingthread is None:
+                    hashed = self.hash_chunk_columns(unstored, executor)
+                else:
+                    hashed = hashingthread.submit(self.hash_chunk_columns, unstored, executor)
+                inflight.append((chunkindex, rowcount, chunkprint, distinct, unstored, hashed))
+
+                while len(inflight) > depth:
+                    self.store_chunk(fullname, sheet2process, fields2hash, pending, incremental, *inflight.popleft())
+                    processed += 1
+            while inflight:
+                self.store_chunk(fullname, sheet2process, fields2hash, pending, incremental, *inflight.popleft())
+                processed += 1
+            self.check_cancelled()
+        finally:
+            chunks.close()
+            if hashingthread is not None:
+                hashingthread.shutdown()
+            if executor is not None:
+                executor.shutdown()
+
+        if incremental:
+            self.record_input(fullname, sheet2process, fingerprint, chunkcount)
+        return processed
+
+    def prepare_chunks(self, chunks, fields2hash, recorded=None):
+        """ Reading stage of create_temp_db: find the distinct values of every field/column in each chunk of rows.
+
+        :param chunks: Chunks of rows from read_sheet_rows or read_sheet_text_rows
+        :param fields2hash: Fields/columns selected for processing
+        :param recorded: Chunk fingerprints recorded in the state file, see recorded_fingerprints, or None
+        :return: Generator of (chunk index, number of rows, chunk fingerprint, distinct values) tuples. The
+                 distinct values are a list for every field, or None for a chunk unchanged since it was recorded.
+        """
+        import pandas as pd
+
+        statistics = self.statistics
+        chunkindex = 0
+        while True:
+            started = time.perf_counter()
+            rows = next(chunks, None)
+            if rows is None:
+                break
+            chunkprint = None
+            if recorded is not None:
+                chunkprint = chunk_fingerprint(rows)
+                if recorded.get(chunkindex) == (len(rows), chunkprint):
+                    statistics.add('read', rows=len(rows), elapsed=time.perf_counter() - started)
+                    yield chunkindex, len(rows), chunkprint, None
+                    chunkindex += 1
+                    continue
+            chunk = pd.DataFrame(rows, columns=fields2hash, dtype=object)
+            for field in fields2hash:
+                if self.normalization.get(field):
+                    chunk[field] = normalize_values(chunk[field], self.normalization[field])
+            distinct = [chunk[field].dropna().map(stored_value).drop_duplicates().tolist() for field in fields2hash]
+            statistics.add('read', rows=len(rows), elapsed=time.perf_counter() - started)
+            yield chunkindex, len(rows), chunkprint, distinct
+            chunkindex += 1
+        chunks.close()
+
+    def hash_chunk_columns(self, unstored, executor=None):
+        """ Hashing stage of create_temp_db, see hash_columns.
+
+        :param unstored: List with the values not stored yet of every field/column
+        :param executor: Optional pool from create_hashing_pool
+        :return: List with a list of binary digests for each field/column
+        """
+        started = time.perf_counter()
+        hashed = self.hash_columns(unstored, executor)
+        self.statistics.add('hash', rows=sum(len(values) for values in unstored), elapsed=time.perf_counter() - started)
+        return hashed
+
+    def store_chunk(self, fullname, sheet2process, fields2hash, pending, incremental, chunkindex, rowcount, chunkprint,
+                    distinct, unstored, hashed):
+        """ Storage stage of create_temp_db: store the hashed values of a chunk and, with a state file, record the
+            chunk's fingerprint.
+
+        :param fullname: Path of the Excel input file
+        :param sheet2process: Sheet the chunk was read from
+        :param fields2hash: Fields/columns selected for processing
+        :param pending: Values of every field/column handed to the hashing stage and not stored yet
+        :param incremental: Whether the chunk's fingerprint is recorded
+        :param chunkindex: Zero-based position of the chunk within the sheet
+        :param rowcount: Number of rows in the chunk
+        :param chunkprint: Fingerprint of the chunk
+        :param distinct: List with the distinct values of every field/column
+        :param unstored: List with the values of every field/column that were hashed
+        :param hashed: Digests of unstored, or a future of them when pipelined
+        """
+        if not isinstance(hashed, list):
+            hashed = hashed.result()
+        started = time.perf_counter()
+        stored = 0
+        for field, plaintext, hashvalue in zip(fields2hash, unstored, hashed):
+            stored += self.store_hashes(field, plaintext, hashvalue)
+            pending[field].difference_update(plaintext)
+        if incremental:
+            self.record_chunk(fullname, sheet2process, chunkindex, rowcount, chunkprint, fields2hash, distinct)
+        self.statistics.add('store', rows=stored, elapsed=time.perf_counter() - started)
+
+    def create_combined_temp_db(self, sources, fields2hash):
+        """ Process several sheets and/or files into one temporary database, so that values occurring in more
+            than one of them are de-duplicated, hashed only once and written to one combined set of mapfiles.
+
+            With a state file (self.statefile), only what changed since the previous run over the same state file
+            is processed, and the mappings of rows no longer in the inputs are removed.
+            Every chunk is committed to the state file as it is stored, so a run that was interrupted or cancelled
+            (see cancel) resumes after the last chunk committed and reuses the values hashed so far.
+
+            The number of sheets the Excel mapfiles will need is estimated before reading, see estimate_layout.
+
+        :param sources: List of (Excel input file path, sheet name) pairs to be processed.
+        :param fields2hash: Fields/columns selected for processing. Their position is looked up in every sheet.
+        :return: Number of chunks of rows hashed and stored, plus the number of mappings removed. Zero when none of
+                 the inputs changed since the previous run.
+        """
+        columns = []
+        for fullname, sheet2process in sources:
+            header = read_sheet_header(fullname, sheet2process)
+            missing = [field for field in fields2hash if field not in header]
+            if missing:
+                raise ValueError("Column(s) not found in sheet '{0}' of {1}: {2}".format(
+                    sheet2process, fullname, ', '.join(missing)))
+            columns.append([header[field] for field in fields2hash])
+
+        self.files2process = sources
+        self.fields2process = fields2hash
+        self.layout = self.estimate_layout(sources, fields2hash)
+        incremental = self.statefile is not None and self.dbname == self.statefile
+        changes = int(incremental and self.reset_fingerprints(fields2hash))
+        for (fullname, sheet2process), cols2hash in zip(sources, columns):
+            self.check_cancelled()
+            inputdirectory, fileselected = os.path.split(fullname)
+            changes += self.create_temp_db(fileselected, sheet2process, fields2hash, cols2hash,
+                                           os.path.join(inputdirectory, ''))
+        if incremental:
+            changes += self.prune_fingerprints(sources)
+        return changes
 
     def process_hash_mapfile_summary(self, fileextension, outputdirectory):
         """ Processing logic for hashing the file and fields/columns selected by the
@@ -190,18 +2187,17 @@ class ExcelCryptoHash(object):
                                version of the original values.
                  File Name: Hashed_<Original input Excel file name>_<hash format chosen>.<fileextension>
         """
+        import pandas as pd
 
-        # Set up ExcelWriter and then write data to summary Excel file
+        # Set up ExcelWriter and then write data to summary Excel file, one chunk of rows at a time
         compositewriter = pd.ExcelWriter(outputdirectory + 'Hash_MapFile_Summary_' + self.hstr + fileextension,
                                          engine='xlsxwriter')
-
-        with self.SQLiteconnection.connect() as connection:
-            results = connection.execution_options(stream_results=True).execute(
-                'SELECT * FROM data ORDER BY ColumnName, Plaintext')
-            df = pd.DataFrame(string_folding_wrapper(results))
-            df = df.rename(columns={0: 'ColumnName', 1: 'Plaintext', 2: 'Hashvalue'})
-            df.to_excel(compositewriter, 'Hash_MapFile_Summary', index=False)
-        compositewriter.save()
+        columns = ('ColumnName', 'Plaintext', 'Hashvalue')
+        frames = self.iterate_query_frames('SELECT ColumnName, Plaintext, ' + self.hash_expression() +
+                                           ' FROM data ORDER BY ColumnName, Plaintext', (), columns,
+                                           categorical=('ColumnName',))
+        self.write_frames(frames, compositewriter, 'Hash_MapFile_Summary', columns)
+        compositewriter.close()
 
     def process_hash_mapfile_detail(self, fields2hash, fileextension, outputdirectory):
         """ Create an output file with a separate mapfile sheet for each field/column selected for hashing with
@@ -216,23 +2212,337 @@ class ExcelCryptoHash(object):
                  Sheet Names: Field/column name. One sheet for each field/column chosen for hashing.
                  File Name: Hash_MapFile_Detail_<hash format chosen>.<fileextension>
         """
+        import pandas as pd
 
         self.distinctoutputname = outputdirectory + 'Hash_MapFile_Detail_' + self.hstr + fileextension
-        detailwriter = pd.ExcelWriter(self.distinctoutputname)
+        detailwriter = pd.ExcelWriter(self.distinctoutputname, engine='xlsxwriter')
 
+        used = set()
         for field in fields2hash:
-            with self.SQLiteconnection.connect() as connection:
-                stmt = sa.text("SELECT * FROM data where ColumnName == :colname ORDER BY Plaintext")
-                results = connection.execution_options(stream_results=True).execute(stmt, colname=field)
-                df = pd.DataFrame(string_folding_wrapper(results))
-                df = df.rename(columns={0: 'ColumnName', 1: 'Plaintext', 2: 'Hashvalue'})
-                df.drop('ColumnName', axis=1, inplace=True)
-                # Check for invalid Excel sheet name characters and length
-                field = re.sub('[\<\>\*\\\/\?|]', '_', field)
-                field = re.sub('History', 'Hist', field, flags=re.IGNORECASE)
-                field = field[0:30].strip()
-                df.to_excel(detailwriter, sheet_name=field, index=False)
-        detailwriter.save()
+            columns = ('Plaintext', 'Hashvalue')
+            frames = self.iterate_query_frames('SELECT Plaintext, ' + self.hash_expression() +
+                                               ' FROM data where ColumnName == ? ORDER BY Plaintext', (field,),
+                                               columns)
+            # Check for invalid Excel sheet name characters and length
+            self.write_frames(frames, detailwriter, excel_sheet_name(field), columns, used)
+        detailwriter.close()
+
+    def iterate_query_frames(self, statement, parameters=(), columns=(), categorical=()):
+        """ Stream the rows of a query against the temporary database as DataFrames of at most self.chunksize
+            rows, so that only one chunk is held in memory at a time.
+
+        :param statement: SQL statement with qmark style parameters
+        :param parameters: Parameters of the statement
+        :param columns: Column names of the DataFrames
+        :param categorical: Columns to dictionary encode (categorical dtype), e.g. ColumnName, which holds only a
+                            handful of distinct values
+        :return: Generator of DataFrames
+        """
+        import pandas as pd
+
+        for rows in self.iterate_query_chunks(statement, parameters, self.chunksize):
+            frame = pd.DataFrame.from_records(rows, columns=columns)
+            for column in categorical:
+                frame[column] = frame[column].astype('category')
+            yield frame
+
+    def write_frames(self, frames, writer, sheet_name, columns, used=None):
+        """ Write DataFrames one below the other to a sheet, with the column names as the first row. Rows beyond
+            self.maxsheetrows roll over to numbered sheets (sheet_name_2, ...), see ShardedWorksheet.
+
+        :param frames: DataFrames with the same columns, see iterate_query_frames
+        :param writer: pandas ExcelWriter
+        :param sheet_name: Name of the sheet
+        :param columns: Column names, written on their own when there are no rows
+        :param used: Set of the lower-cased sheet names already in the workbook, see unique_sheet_name
+        :return: Number of rows written
+        """
+        import pandas as pd
+
+        used = set() if used is None else used
+        capacity = self.maxsheetrows - 1
+        sheetname = unique_sheet_name(sheet_name, used)
+        written = sheetrows = 0
+        for frame in frames:
+            while len(frame):
+                if sheetrows == capacity:
+                    sheetname = unique_sheet_name(sheet_name, used)
+                    sheetrows = 0
+                part = frame.iloc[:capacity - sheetrows]
+                frame = frame.iloc[capacity - sheetrows:]
+                header = sheetrows == 0
+                part.to_excel(writer, sheet_name=sheetname, index=False, header=header,
+                              startrow=0 if header else sheetrows + 1)
+                sheetrows += len(part)
+                written += len(part)
+        if written == 0:
+            pd.DataFrame(columns=columns).to_excel(writer, sheet_name=sheetname, index=False)
+        return written
+
+    def write_outputs(self, fields2hash, fileextension, outputdirectory, hashedoutputs=()):
+        """ Write the summary and the detail mapfiles (see process_hash_mapfiles) and the Hashed_ copies of the input
+            files (see write_hashed_outputfile) of every hash format. They are independent of each other, so with
+            self.outputworkers > 1 each is written by its own worker process, reading its mappings straight from the
+            temporary database, and the output stage takes as long as the slowest writer. An in-memory temporary
+            database is first copied to a file the worker processes can open.
+
+        :param fields2hash: Fields/columns selected to be hashed.
+        :param fileextension: File extension of input file.
+        :param outputdirectory: Directory chosen for generated output files.
+        :param hashedoutputs: List of (fileselected, sheet2process, fileextension, inputdirectory) tuples of the
+                              input files to write a Hashed_ copy of
+        :return: List of the names of the Hashed_ copies written
+        """
+        if self.outputworkers <= 1:
+            self.process_hash_mapfiles(fields2hash, fileextension, outputdirectory)
+            outputnames = []
+            primary = self.hstr
+            try:
+                for hstr in self.hstrs:
+                    self.select_hash(hstr)
+                    for fileselected, sheet2process, extension, inputdirectory in hashedoutputs:
+                        self.check_cancelled()
+                        outputnames.append(self.write_hashed_outputfile(fileselected, sheet2process, fields2hash,
+                                                                        extension, inputdirectory, outputdirectory))
+            finally:
+                self.select_hash(primary)
+            return outputnames
+
+        if self.outputformat != 'xlsx' and self.outputformat not in mapfile_writers:
+            raise ValueError('Unknown output format: ' + str(self.outputformat))
+        tasks = []
+        for hstr in self.hstrs:
+            if self.outputformat == 'xlsx':
+                arguments = (fields2hash, fileextension, outputdirectory)
+            else:
+                arguments = (outputdirectory,)
+            tasks.extend((part, hstr, arguments) for part in ('summary', 'detail'))
+            tasks.extend(('output', hstr, (fileselected, sheet2process, fields2hash, extension, inputdirectory,
+                                           outputdirectory))
+                         for fileselected, sheet2process, extension, inputdirectory in hashedoutputs)
+
+        dbname = self.dbname
+        if dbname == ':memory:':
+            dbhandle, dbname = tempfile.mkstemp(prefix='itellihashexcel_', suffix='.db', dir=self.tempdirectory)
+            os.close(dbhandle)
+            os.remove(dbname)
+            connection = self.SQLiteconnection.raw_connection()
+            try:
+                connection.cursor().execute('VACUUM INTO ?', (dbname,))
+            finally:
+                connection.close()
+        settings = {'dbname': dbname, 'hstrs': list(self.hstrs), 'digestencoding': self.digestencoding,
+                    'outputformat': self.outputformat, 'maxsheetrows': self.maxsheetrows, 'chunksize': self.chunksize,
+                    'textinput': self.textinput, 'normalization': self.normalization,
+                    'replacevalues': self.replacevalues, 'files2process': self.files2process}
+
+        outputnames = []
+        statistics = self.statistics
+        total = self.count_hashes()
+        statistics.expect('summary', total * len(self.hstrs))
+        statistics.expect('detail', total * len(self.hstrs))
+        if hashedoutputs:
+            statistics.expect('output', ((statistics.stages['read']['expected'] or 0) + total) * len(self.hstrs))
+        # The writers check a token shared with this process, which is set once this run is cancelled
+        import multiprocessing
+
+        manager = multiprocessing.Manager()
+        cancelled = manager.Event()
+        executor = ProcessPoolExecutor(max_workers=min(self.outputworkers, len(tasks)))
+        try:
+            futures = dict((executor.submit(write_output, settings, part, hstr, arguments, cancelled), part)
+                           for part, hstr, arguments in tasks)
+            pending = set(futures)
+            results = {}
+            while pending:
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                if self.cancelled.is_set():
+                    cancelled.set()
+                    executor.shutdown(cancel_futures=True)
+                    self.check_cancelled()
+                for future in done:
+                    results[future], stages = future.result()
+                    for stage, counters in stages.items():
+                        if counters['rows'] or counters['bytes']:
+                            statistics.add(stage, rows=counters['rows'], nbytes=counters['bytes'],
+                                           elapsed=counters['elapsed'])
+            outputnames = [results[future] for future, part in futures.items() if part == 'output']
+        finally:
+            cancelled.set()
+            executor.shutdown(cancel_futures=True)
+            manager.shutdown()
+            if dbname != self.dbname:
+                os.remove(dbname)
+        return outputnames
+
+    def process_hash_mapfiles(self, fields2hash, fileextension, outputdirectory):
+        """ Create the summary and the detail mapfiles (see process_hash_mapfile_summary and
+            process_hash_mapfile_detail) together from a single sorted scan of the temporary database, in the format
+            chosen by self.outputformat: 'xlsx' (default), 'parquet' or 'csv.gz'.
+
+        :param fields2hash: Fields/columns selected to be hashed.
+        :param fileextension: File extension of input file. Macro-enabled files get .xlsx mapfiles.
+        :param outputdirectory: Directory chosen for generated output files.
+        :return: Summary and detail 'mapfiles'. See write_excel_mapfiles and write_flat_mapfiles. One set of
+                 mapfiles is written for every hash format computed, see identify_hashes.
+        """
+        if self.outputformat != 'xlsx' and self.outputformat not in mapfile_writers:
+            raise ValueError('Unknown output format: ' + str(self.outputformat))
+        primary = self.hstr
+        try:
+            for hstr in (self.hstrs if len(self.hstrs) > 1 else [primary]):
+                self.check_cancelled()
+                self.select_hash(hstr)
+                if self.outputformat == 'xlsx':
+                    self.write_excel_mapfiles(fields2hash, fileextension, outputdirectory)
+                else:
+                    self.write_flat_mapfiles(outputdirectory)
+        finally:
+            self.select_hash(primary)
+
+    def write_excel_mapfiles(self, fields2hash, fileextension, outputdirectory, parts=('summary', 'detail')):
+        """ Write the summary and the detail Excel mapfiles from a single sorted scan of the temporary database.
+            Every row is written straight to both workbooks, which are written in constant-memory mode, so memory
+            use does not grow with the number of hashed values.
+
+        :param fields2hash: Fields/columns selected to be hashed.
+        :param fileextension: File extension of input file. Macro-enabled files get .xlsx mapfiles.
+        :param outputdirectory: Directory chosen for generated output files.
+        :param parts: The mapfiles to write, 'summary' and/or 'detail', e.g. one each in a worker process, see
+                      write_outputs
+        :return: Summary and detail Excel 'mapfiles' with the same characteristics as process_hash_mapfile_summary
+                 and process_hash_mapfile_detail.
+        """
+        import xlsxwriter
+
+        if fileextension.lower() == '.xlsm':
+            fileextension = '.xlsx'
+        options = {'constant_memory': True, 'strings_to_urls': False, 'strings_to_formulas': False,
+                   'default_date_format': 'yyyy-mm-dd hh:mm:ss'}
+        statistics = self.statistics
+        total = self.count_hashes()
+        # The mapfiles of every hash format computed are written in turn, see process_hash_mapfiles
+        for part in parts:
+            statistics.expect(part, total * len(self.hstrs))
+
+        summaryname = outputdirectory + 'Hash_MapFile_Summary_' + self.hstr + fileextension
+        self.distinctoutputname = outputdirectory + 'Hash_MapFile_Detail_' + self.hstr + fileextension
+        summary = detail = summarysheet = detailsheets = None
+        try:
+            if 'summary' in parts:
+                summary = xlsxwriter.Workbook(summaryname, options)
+                summarysheet = ShardedWorksheet(summary, 'Hash_MapFile_Summary', set(),
+                                                ('ColumnName', 'Plaintext', 'Hashvalue'), total, self.maxsheetrows,
+                                                summary.add_format({'bold': True, 'border': 1}))
+
+            if 'detail' in parts:
+                # Add the detail sheets up front so they appear in the order the fields/columns were selected in.
+                # Constant-memory mode only requires the rows of each sheet to be written in order.
+                counts = self.count_hashes_by_column()
+                detail = xlsxwriter.Workbook(self.distinctoutputname, options)
+                used = set()
+                headerformat = detail.add_format({'bold': True, 'border': 1})
+                detailsheets = {}
+                for field in fields2hash:
+                    detailsheets[field] = ShardedWorksheet(detail, excel_sheet_name(field), used,
+                                                           ('Plaintext', 'Hashvalue'), counts.get(field, 0),
+                                                           self.maxsheetrows, headerformat)
+
+            started = time.perf_counter()
+            for rows in self.iterate_query_chunks('SELECT ColumnName, Plaintext, ' + self.hash_expression() +
+                                                  ' FROM data ORDER BY ColumnName, Plaintext', (), self.chunksize):
+                self.check_cancelled()
+                if summarysheet is not None:
+                    for row in rows:
+                        summarysheet.write_row(row)
+                    finished = time.perf_counter()
+                    statistics.add('summary', rows=len(rows), elapsed=finished - started)
+                    started = finished
+
+                if detailsheets is not None:
+                    for columnname, group in groupby(rows, key=itemgetter(0)):
+                        detailsheet = detailsheets[columnname]
+                        for row in group:
+                            detailsheet.write_row(row[1:])
+                    finished = time.perf_counter()
+                    statistics.add('detail', rows=len(rows), elapsed=finished - started)
+                    started = finished
+        finally:
+            closing = []
+            for part, workbook, filename in (('summary', summary, summaryname),
+                                             ('detail', detail, self.distinctoutputname)):
+                if workbook is not None:
+                    started = time.perf_counter()
+                    workbook.close()
+                    closing.append((part, filename, time.perf_counter() - started))
+        for part, filename, elapsed in closing:
+            statistics.add(part, nbytes=os.path.getsize(filename), elapsed=elapsed)
+
+    def write_flat_mapfiles(self, outputdirectory, parts=('summary', 'detail')):
+        """ Write the summary and the detail mapfiles as Parquet or gzip compressed CSV (self.outputformat) from a
+            single sorted scan of the temporary database, streamed in chunks of self.chunksize rows.
+
+        :param outputdirectory: Directory chosen for generated output files.
+        :param parts: The mapfiles to write, 'summary' and/or 'detail', see write_excel_mapfiles
+        :return: Mapfiles with the following characteristics:
+                 Summary: Hash_MapFile_Summary_<hash format chosen>.<format> with columns ColumnName, Plaintext,
+                          Hashvalue.
+                 Detail: One file per hashed field/column, named like the detail mapfile sheets, with columns
+                         Plaintext, Hashvalue, in the directory Hash_MapFile_Detail_<hash format chosen>.
+        """
+        writerclass = mapfile_writers[self.outputformat]
+        detaildirectory = outputdirectory + 'Hash_MapFile_Detail_' + self.hstr
+        if 'detail' in parts and not os.path.isdir(detaildirectory):
+            os.makedirs(detaildirectory)
+
+        statistics = self.statistics
+        total = self.count_hashes()
+        # The mapfiles of every hash format computed are written in turn, see process_hash_mapfiles
+        for part in parts:
+            statistics.expect(part, total * len(self.hstrs))
+
+        summaryname = outputdirectory + 'Hash_MapFile_Summary_' + self.hstr + writerclass.extension
+        summary = None
+        if 'summary' in parts:
+            summary = writerclass(summaryname, ('ColumnName', 'Plaintext', 'Hashvalue'))
+        detail = None
+        currentfield = None
+        used = set()
+        try:
+            started = time.perf_counter()
+            statement = ('SELECT ColumnName, Plaintext, ' + self.hash_expression(writerclass.binary) +
+                         ' FROM data ORDER BY ColumnName, Plaintext')
+            for rows in self.iterate_query_chunks(statement, (), self.chunksize):
+                self.check_cancelled()
+                if summary is not None:
+                    summary.write_rows(rows)
+                    finished = time.perf_counter()
+                    statistics.add('summary', rows=len(rows), elapsed=finished - started)
+                    started = finished
+
+                if 'detail' in parts:
+                    for columnname, group in groupby(rows, key=itemgetter(0)):
+                        if columnname != currentfield:
+                            if detail is not None:
+                                detail.close()
+                            currentfield = columnname
+                            detail = writerclass(os.path.join(detaildirectory, unique_sheet_name(
+                                excel_sheet_name(columnname), used) + writerclass.extension),
+                                ('Plaintext', 'Hashvalue'))
+                        detail.write_rows([row[1:] for row in group])
+                    finished = time.perf_counter()
+                    statistics.add('detail', rows=len(rows), elapsed=finished - started)
+                    started = finished
+        finally:
+            if summary is not None:
+                summary.close()
+            if detail is not None:
+                detail.close()
+        if summary is not None:
+            statistics.add('summary', nbytes=os.path.getsize(summaryname))
+        if 'detail' in parts:
+            statistics.add('detail', nbytes=sum(os.path.getsize(os.path.join(detaildirectory, name))
+                                                for name in os.listdir(detaildirectory)))
 
     def create_hashed_outputfile(self, fileselected, sheet2process, fileextension, inputdirectory, outputdirectory):
         """ Create an output file containing the original input file sheet selected for processing with the original
@@ -252,6 +2562,10 @@ class ExcelCryptoHash(object):
                  File Name: Hashed_<Input Excel File Name>_<hash format chosen>.<fileextension>
 
         """
+        import pandas as pd
+        import xlwings as xw
+        from openpyxl import load_workbook
+
         inputname = inputdirectory + fileselected
 
         outputname = outputdirectory + 'Hashed_' + fileselected.replace(fileextension, '_' + self.hstr + fileextension)
@@ -274,3 +2588,196 @@ class ExcelCryptoHash(object):
 
         wb.save()
         wb.close()
+
+    def lookup_hashes(self, field, plaintexts):
+        """ Look up the hash values of the hash format selected for writing (see select_hash) of a field/column in
+            the temporary database.
+
+        :param field: Field/column name
+        :param plaintexts: Distinct original values, as stored by create_temp_db
+        :return: List of the text encoded hash values, in the same order as plaintexts; None for a value not stored
+        """
+        hashvalues = [None] * len(plaintexts)
+        if not plaintexts:
+            return hashvalues
+        connection = self.SQLiteconnection.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS lookups (Position INTEGER PRIMARY KEY, Plaintext)')
+            cursor.executemany('INSERT INTO temp.lookups VALUES (?, ?)', enumerate(plaintexts))
+            # Joining on the position returns every value exactly as it was passed in, whatever its type
+            cursor.execute('SELECT l.Position, ' + self.hash_expression() + ' FROM temp.lookups l JOIN data d '
+                           'ON d.ColumnName = ? AND d.Plaintext = l.Plaintext', (field,))
+            for position, hashvalue in cursor:
+                hashvalues[position] = hashvalue
+            cursor.execute('DELETE FROM temp.lookups')
+            connection.commit()
+            return hashvalues
+        finally:
+            connection.close()
+
+    def replace_hashed_values(self, fullname, sheet2process, fields2hash, rows):
+        """ Replace the values of the fields/columns selected for hashing with their hash values, one chunk of rows
+            at a time, so that memory use does not depend on the size of the sheet. The values are read and
+            normalized as create_temp_db did (see textinput and normalization) and looked up in the temporary
+            database, see lookup_hashes.
+
+        :param fullname: Path of the Excel input file
+        :param sheet2process: Sheet the rows are read from
+        :param fields2hash: Fields/columns selected to be hashed
+        :param rows: Iterator of the rows of openpyxl cells of the sheet, starting with the header row
+        :return: Generator of lists of rows, the first holding only the header row. The cells of the fields/columns
+                 selected for hashing are replaced with their hash values.
+        """
+        import pandas as pd
+
+        header = read_sheet_header(fullname, sheet2process)
+        cols2hash = [header[field] for field in fields2hash]
+        # The stored values are read as create_temp_db read them, in step with the rows: the rows themselves keep
+        # their formulas, whereas the stored values of formula cells are their calculated values
+        reader = read_sheet_text_rows if self.textinput else read_sheet_rows
+        keys = (row for chunk in reader(fullname, sheet2process, cols2hash, self.chunksize) for row in chunk)
+        width = max(cols2hash) + 1
+        for index, chunk in enumerate(chunked(rows, self.chunksize)):
+            if index == 0:
+                yield chunk[:1]
+                chunk = chunk[1:]
+            chunk = [list(row) + [None] * (width - len(row)) for row in chunk]
+            frame = pd.DataFrame(list(islice(keys, len(chunk))), columns=fields2hash, dtype=object)
+            for field, col in zip(fields2hash, cols2hash):
+                values = frame[field]
+                if self.normalization.get(field):
+                    values = normalize_values(values, self.normalization[field])
+                values = [None if pd.isna(value) else stored_value(value) for value in values.tolist()]
+                distinct = list(OrderedDict.fromkeys(value for value in values if value is not None))
+                hashvalues = dict(zip(distinct, self.lookup_hashes(field, distinct)))
+                missing = [value for value in distinct if hashvalues[value] is None]
+                if missing:
+                    # Never leave a plaintext value behind
+                    raise ValueError("{0} value(s) of column '{1}' in sheet '{2}' of {3} are not in the temporary "
+                                     "database".format(len(missing), field, sheet2process, fullname))
+                for row, value in zip(chunk, values):
+                    row[col] = None if value is None else hashvalues[value]
+            yield chunk
+
+    def write_hashed_outputfile(self, fileselected, sheet2process, fields2hash, fileextension, inputdirectory,
+                                outputdirectory):
+        """ Create the same output file as create_hashed_outputfile without Microsoft Excel. The input file is copied
+            part by part, unchanged (see WorkbookPackage), and a mapping sheet for each field/column selected for
+            hashing is streamed straight from the temporary database into the copy, after the sheet selected for
+            processing.
+
+            With self.replacevalues, the values of the fields/columns selected for hashing are replaced with their
+            hash values instead, see write_replaced_outputfile.
+
+        :param outputdirectory: Directory chosen for generated output files.
+        :param inputdirectory: Directory associated with input file.
+        :param fileselected: Excel input file selected for processing.
+        :param sheet2process: Sheet selected by user to be processed.
+        :param fields2hash: Fields/columns selected to be hashed.
+        :param fileextension: File extension of input file.
+        :return: Name of the hashed Excel output file, with the same characteristics as create_hashed_outputfile.
+        """
+        inputname = inputdirectory + fileselected
+        outputname = outputdirectory + 'Hashed_' + fileselected.replace(fileextension, '_' + self.hstr + fileextension)
+        if self.replacevalues:
+            return self.write_replaced_outputfile(inputname, outputname, sheet2process, fields2hash, fileextension)
+
+        statistics = self.statistics
+        statistics.expect('output', self.count_hashes())
+        used = set(name.lower() for name in read_sheet_names(inputname))
+        package = WorkbookPackage(inputname, outputname)
+        try:
+            package.copy_parts(self.check_cancelled)
+            for field in fields2hash:
+                worksheet = ShardedWorksheetPart(package, excel_sheet_name(field), used, ('Plaintext', 'Hashvalue'),
+                                                 self.maxsheetrows)
+                try:
+                    started = time.perf_counter()
+                    for rows in self.iterate_query_chunks('SELECT Plaintext, ' + self.hash_expression() + ' FROM data '
+                                                          'WHERE ColumnName == ? ORDER BY Plaintext', (field,),
+                                                          self.chunksize):
+                        self.check_cancelled()
+                        worksheet.write_rows(rows)
+                        finished = time.perf_counter()
+                        statistics.add('output', rows=len(rows), elapsed=finished - started)
+                        started = finished
+                finally:
+                    worksheet.close()
+            package.finish(sheet2process)
+        finally:
+            package.close()
+        statistics.add('output', nbytes=os.path.getsize(outputname))
+        return outputname
+
+    def write_replaced_outputfile(self, inputname, outputname, sheet2process, fields2hash, fileextension):
+        """ Write the Hashed_ copy of an input file with the values of the fields/columns selected for hashing
+            replaced with their hash values, in every sheet of the file processed (see create_combined_temp_db),
+            and without mapping sheets, so that the output holds none of the plaintext values of those
+            fields/columns. The input file cannot be copied part by part, as its shared strings, pivot caches and
+            calculation chain may still hold those values; every sheet is streamed row by row into a new workbook
+            written in constant-memory mode instead. Cell values, formulas, number formats, column widths, merged
+            cells and VBA macros are kept; other formatting is not.
+
+        :param inputname: Path of the Excel input file
+        :param outputname: Path of the output file
+        :param sheet2process: Sheet selected by user to be processed.
+        :param fields2hash: Fields/columns selected to be hashed.
+        :param fileextension: File extension of input file.
+        :return: Name of the output file. A macro-enabled input file without macros is written with the .xlsx
+                 extension.
+        """
+        import xlsxwriter
+        from openpyxl import load_workbook
+
+        with zipfile.ZipFile(inputname) as archive:
+            vbaproject = archive.read('xl/vbaProject.bin') if 'xl/vbaProject.bin' in archive.namelist() else None
+        if vbaproject is None and fileextension.lower() == '.xlsm':
+            outputname = os.path.splitext(outputname)[0] + '.xlsx'
+
+        statistics = self.statistics
+        statistics.expect('output', statistics.stages['read']['expected'] or 0)
+        source = load_workbook(inputname, read_only=True, keep_vba=False)
+        workbook = xlsxwriter.Workbook(outputname, {'constant_memory': True, 'strings_to_urls': False,
+                                                    'strings_to_formulas': False,
+                                                    'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+        try:
+            if vbaproject is not None:
+                workbook.add_vba_project(io.BytesIO(vbaproject), is_stream=True)
+            numberformats = NumberFormats(workbook)
+            sheets2replace = set(sheet for source2process, sheet in (self.files2process or [])
+                                 if os.path.abspath(source2process) == os.path.abspath(inputname))
+            sheets2replace.add(sheet2process)
+
+            for sheetname in source.sheetnames:
+                worksheet = workbook.add_worksheet(sheetname)
+                columns, merges = read_sheet_layout(inputname, sheetname)
+                for first, last, width, hidden in columns:
+                    if width is None:
+                        worksheet.set_column(first, last, None, None, {'hidden': hidden})
+                    else:
+                        # Widths are recorded in characters of 7 pixels, including 5 pixels of padding
+                        worksheet.set_column_pixels(first, last, int(round(width * 7)), None, {'hidden': hidden})
+                # merge_range would write the cells of the range, which constant-memory mode only allows in row order
+                worksheet.merge.extend(list(merge) for merge in merges)
+
+                r = 0
+                started = time.perf_counter()
+                chunks = chunked(source[sheetname].iter_rows(), self.chunksize)
+                if sheetname in sheets2replace:
+                    chunks = self.replace_hashed_values(inputname, sheetname, fields2hash,
+                                                        source[sheetname].iter_rows())
+                for rows in chunks:
+                    self.check_cancelled()
+                    for row in rows:
+                        write_cells(worksheet, r, row, numberformats)
+                        r += 1
+                    finished = time.perf_counter()
+                    statistics.add('output', rows=len(rows), elapsed=finished - started)
+                    started = finished
+        finally:
+            started = time.perf_counter()
+            workbook.close()
+            source.close()
+        statistics.add('output', nbytes=os.path.getsize(outputname), elapsed=time.perf_counter() - started)
+        return outputname
@@ -23,6 +23,7 @@
     """
 
 import gettext
+import multiprocessing
 import os
 import sys
 import threading
@@ -31,7 +32,6 @@ import excelcryptohashinglogic as chl
 import itellihashexcelimages_white as itellihashexcelimages
 import wx
 import wx.lib.scrolledpanel
-from openpyxl import load_workbook
 from wx.adv import AboutDialogInfo
 from wx.lib.itemspicker import (ItemsPicker, EVT_IP_SELECTION_CHANGED, IP_SORT_CHOICES, IP_SORT_SELECTED)
 from wx.lib.wordwrap import wordwrap
@@ -63,6 +63,10 @@ _utglobe = wx.Colour(0, 108, 147)  # Blue
 _utregalia = wx.Colour(117, 74, 126)  # Purple
 _utwhite = wx.Colour(255, 255, 255)  # White
 
+_stagelabels = {'read': "Reading input file", 'hash': "Hashing selected columns", 'store': "Storing hashed values",
+                'summary': "Writing summary mapping file", 'detail': "Writing detail mapping file",
+                'output': "Writing output file"}
+
 
 class FieldsPickerDialog(wx.Dialog):
     """
@@ -134,20 +138,29 @@ class WorkerThread(threading.Thread):
         self.timeToQuit.set()
 
     def run(self):
+        # The hashing logic checks timeToQuit between chunks and stages, so stop() cancels a run in progress
+        mychl.cancelled = self.timeToQuit
         wx.CallAfter(self.window.statusBar.SetLabel, "Creating temporary database... please wait...")
-        mychl.create_temp_db(self.window.fileselected, self.window.sheet2process, self.window.fields2hash,
-                             self.window.cols2hash, self.window.inputdirectory)
-        wx.CallAfter(self.window.statusBar.SetLabel, "Creating & writing summary mapping file... please wait...")
-        mychl.process_hash_mapfile_summary(self.window.fileextension, self.window.outputdirectory)
-        wx.CallAfter(self.window.statusBar.SetLabel, "Creating & writing detail mapping file... please wait...")
-        mychl.process_hash_mapfile_detail(self.window.fields2hash, self.window.fileextension,
-                                          self.window.outputdirectory)
-        wx.CallAfter(self.window.statusBar.SetLabel,
-                     "Creating & writing output file with a separate sheet for each selected column... please wait...")
-        mychl.create_hashed_outputfile(self.window.fileselected, self.window.sheet2process, self.window.fileextension,
-                                       self.window.inputdirectory,
-                                       self.window.outputdirectory)
-        mychl.remove_sqlite()
+        try:
+            # Also discards a checkpoint left by a run with other columns, see create_combined_temp_db
+            mychl.create_combined_temp_db([(self.window.inputdirectory + self.window.fileselected,
+                                            self.window.sheet2process)], self.window.fields2hash)
+            wx.CallAfter(self.window.statusBar.SetLabel,
+                         "Creating & writing summary and detail mapping files and output file... please wait...")
+            # The three files are written side by side, see ExcelCryptoHash.write_outputs
+            mychl.write_outputs(self.window.fields2hash, self.window.fileextension, self.window.outputdirectory,
+                                [(self.window.fileselected, self.window.sheet2process, self.window.fileextension,
+                                  self.window.inputdirectory)])
+        except chl.OperationCancelled:
+            # A checkpoint is kept, so processing the same file again resumes where this run stopped
+            mychl.remove_sqlite()
+            return
+        except Exception as e:
+            mychl.remove_sqlite()
+            self.timeToQuit.set()
+            wx.CallAfter(self.window.onlongrunfailed, e)
+            return
+        mychl.remove_sqlite(removestate=True)
         self.timeToQuit.set()
         self.window.onlongrundone()
 
@@ -302,6 +315,15 @@ class MainFrame(wx.Frame):
         self.button_Step4B.Enable(False)
         gbSizer_Step2_4.Add(self.button_Step4B, wx.GBPosition(2, 3), wx.GBSpan(1, 2), wx.ALL | wx.EXPAND, 5)
 
+        # Checkpoint
+        self.checkBox_Checkpoint = wx.CheckBox(self, wx.ID_ANY, "Resumable", wx.DefaultPosition, wx.DefaultSize, 0)
+        self.checkBox_Checkpoint.SetToolTip(
+            "Keep a checkpoint file in the output folder while hashing, so that a run that is interrupted or stopped "
+            "resumes where it left off when the same file is processed again. The checkpoint holds the original "
+            "values and is removed once the run completes.")
+        gbSizer_Step2_4.Add(self.checkBox_Checkpoint, wx.GBPosition(3, 0), wx.GBSpan(1, 1),
+                            wx.ALL | wx.ALIGN_CENTER_VERTICAL, 10)
+
         # Progress Gauge
         self.gauge_progress = wx.Gauge(self, wx.ID_ANY, 100, wx.DefaultPosition, wx.DefaultSize, wx.GA_HORIZONTAL)
         gbSizer_Step2_4.Add(self.gauge_progress, wx.GBPosition(3, 1), wx.GBSpan(1, 4), wx.ALL | wx.EXPAND, 10)
@@ -362,6 +384,32 @@ class MainFrame(wx.Frame):
         self.button_Step4B.SetBackgroundColour(self.unselectable)
         self.statusBar.SetLabel("Finished !! You may now exit or process another input file.")
 
+    def onlongrunfailed(self, error):
+        """ Report a hashing run that failed and reset the frame for another run.
+
+        :param error: Exception raised by the hashing logic
+        :return: Status bar shows the error, and whether a checkpoint was kept to resume from.
+        """
+        self.onlongrundone()
+        self.gauge_progress.SetValue(0)
+        message = "Processing failed: {0}".format(error)
+        if mychl.statefile is not None:
+            message += " (checkpoint kept, run again to resume)"
+        self.statusBar.SetLabel(message)
+
+    def onprogress(self, stage, progress):
+        """ Progress callback of the hashing logic, called from the worker thread or its pipeline threads. Moves the
+        progress gauge and shows the rows processed by the current stage.
+
+        :param stage: Stage of the hashing logic reporting progress
+        :param progress: Rows, elapsed time, rows per second and overall percentage complete of the stage
+        :return: Progress gauge and status updated on the GUI thread.
+
+        """
+        wx.CallAfter(self.gauge_progress.SetValue, int(progress['percent']))
+        wx.CallAfter(self.statusBar.SetLabel, "{0}: {rows:,} rows ({rows_per_sec:,.0f} rows/sec)... please wait..."
+                     .format(_stagelabels[stage], **progress))
+
     def radioBtn_NoneOnRadioButton(self, event):
         """ STEP 1. 'None' Hash format selection button. This button is initially 'selected' when the
         program is started. User must select from among the hashing options available to begin
@@ -474,8 +522,8 @@ class MainFrame(wx.Frame):
             self.outputdirectory = self.inputdirectory
             self.fileselected = dialog1A.GetFilename()
             self.fileextension = os.path.splitext(dialog1A.GetPath())[1]
-            self.sheetsavailable = load_workbook(filename=self.fileselected, read_only=True,
-                                                 keep_vba=False).get_sheet_names()
+            # The workbook is probed once; the sheet names and header rows are read from the cached probe
+            self.sheetsavailable = chl.read_sheet_names(self.inputdirectory + self.fileselected)
             dialog1B = wx.SingleChoiceDialog(
                 self, 'Please select sheet to process', 'Sheet Selection',
                 self.sheetsavailable,
@@ -484,12 +532,8 @@ class MainFrame(wx.Frame):
             if dialog1B.ShowModal() == wx.ID_OK:
                 self.sheet2process = dialog1B.GetStringSelection()
                 dialog1B.Destroy()
-                data = load_workbook(filename=self.fileselected, read_only=True, keep_vba=False)
-                sheet = data.get_sheet_by_name(self.sheet2process)
                 try:
-                    self.myDict = {}
-                    for i in range(1, sheet.max_column + 1, 1):
-                        self.myDict[sheet.cell(row=1, column=i).value] = i - 1
+                    self.myDict = chl.read_sheet_header(self.inputdirectory + self.fileselected, self.sheet2process)
                     self.fieldsavailable = ",".join(list(self.myDict.keys()))
                     self.button_Step2.Enable(False)
                     self.button_Step2.SetBackgroundColour(self.unselectable)
@@ -537,9 +581,16 @@ class MainFrame(wx.Frame):
         self.button_Step4A.SetBackgroundColour(self.unselectable)
         self.button_Step4B.Enable(False)
         self.button_Step4B.SetBackgroundColour(self.unselectable)
-        mychl.initialize_sqlite()
+        mychl.progress_callback = self.onprogress
+        mychl.pipelined = True
+        mychl.outputworkers = 3
         mychl.identify_hash(self.hash2use)
-        self.gauge_progress.Pulse()
+        # Checkpoint the run when asked to, so that an interrupted run of the same file resumes where it stopped
+        mychl.statefile = None
+        if self.checkBox_Checkpoint.GetValue():
+            mychl.statefile = self.outputdirectory + 'Hash_State_' + mychl.hstr + '.db'
+        mychl.initialize_sqlite(inputsize=os.path.getsize(self.inputdirectory + self.fileselected))
+        self.gauge_progress.SetValue(0)
         self.statusBar.SetLabel("Setting up processing thread... please wait...")
         try:
             self.count += 1
@@ -567,9 +618,16 @@ class MainFrame(wx.Frame):
         if dialog2.ShowModal() == wx.ID_OK:
             self.outputdirectory = dialog2.GetPath() + '\\'
         dialog2.Destroy()
-        mychl.initialize_sqlite()
+        mychl.progress_callback = self.onprogress
+        mychl.pipelined = True
+        mychl.outputworkers = 3
         mychl.identify_hash(self.hash2use)
-        self.gauge_progress.Pulse()
+        # Checkpoint the run when asked to, so that an interrupted run of the same file resumes where it stopped
+        mychl.statefile = None
+        if self.checkBox_Checkpoint.GetValue():
+            mychl.statefile = self.outputdirectory + 'Hash_State_' + mychl.hstr + '.db'
+        mychl.initialize_sqlite(inputsize=os.path.getsize(self.inputdirectory + self.fileselected))
+        self.gauge_progress.SetValue(0)
         self.statusBar.SetLabel("Setting up processing thread... please wait...")
         try:
             self.count += 1
@@ -581,6 +639,10 @@ class MainFrame(wx.Frame):
             self.statusBar.SetLabel("Unable to start processing thread")
 
     def button_CloseOnButtonClick(self, event):
+        # Let a run in progress stop at its next checkpoint before exiting
+        for thread in self.threads:
+            thread.stop()
+            thread.join(30)
         self.Destroy()
 
     def button_InfoOnButtonClick(self, event):
@@ -637,6 +699,9 @@ class MainFrame(wx.Frame):
 
 
 if __name__ == "__main__":
+    # The hashing logic writes its outputs in worker processes, which a frozen Windows build must not start as
+    # another copy of the GUI
+    multiprocessing.freeze_support()
 
     try:
         app = wx.App(False)
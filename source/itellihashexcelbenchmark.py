@@ -0,0 +1,400 @@
+#! /usr/bin/env python
+# coding: utf-8
+# itellihashexcelbenchmark.py
+# Copyright 2018 iTtelligent, LLC., Kirby J. Davis (kdavis@itelligentllc.com)
+
+"""This file is part of iTelliHashExcel.
+
+    iTelliHashExcel - A Cryptographic Hashing Application for Excel Files
+    Copyright (C) 2018 iTtelligent, LLC (Kirby J. Davis)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+    """
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import excelcryptohashinglogic as chl
+import xlsxwriter
+
+# Largest number of data rows that fits on one sheet below the header row. Larger inputs are spread over
+# several sheets.
+sheetrows = 1048575
+
+valuetypes = ('int', 'text', 'zeropadded', 'float', 'date')
+stagenames = ('read', 'hash', 'store', 'mapfiles', 'legacymapfiles', 'output', 'end2end')
+
+# Modules whose cold import time is budgeted, and the heavy dependencies they must leave to the stage needing them
+startupmodules = ('excelcryptohashinglogic', 'itellihashexcelcli')
+deferredmodules = ('numpy', 'pandas', 'sqlalchemy', 'openpyxl', 'xlsxwriter', 'Crypto', 'xlwings', 'pyarrow')
+
+# Imports a module in a fresh interpreter and reports the seconds taken and the deferred modules it loaded
+startupscript = '''import json, sys, time
+started = time.perf_counter()
+import {0}
+elapsed = time.perf_counter() - started
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {1!r} if m in sys.modules]}}))
+'''
+
+
+def synthetic_value(n, valuetype):
+    """ Turn the n'th distinct value of a synthetic column into a cell value of the given type.
+
+    :param n: Index of the distinct value
+    :param valuetype: One of valuetypes
+    :return: Cell value
+    """
+    if valuetype == 'int':
+        return 100000 + n
+    elif valuetype == 'text':
+        return 'ID-%08d' % n
+    elif valuetype == 'zeropadded':
+        return '%09d' % n
+    elif valuetype == 'float':
+        return n / 100.0
+    return datetime.datetime(1950, 1, 1) + datetime.timedelta(days=n)
+
+
+def generate_workbook(filename, rows, columns, cardinality, valuetype, seed=0):
+    """ Write a synthetic Excel input file.
+
+    :param filename: Name of the file to write
+    :param rows: Number of data rows. Rows beyond one sheet continue on sheets Data_2, Data_3, ...
+    :param columns: Number of columns, named Col1, Col2, ...
+    :param cardinality: Fraction of the rows that are distinct within each column (0 < cardinality <= 1)
+    :param valuetype: Type of the cell values, one of valuetypes
+    :param seed: Seed of the random generator
+    :return: Names of the sheets holding data
+    """
+    rng = random.Random(seed)
+    distinct = max(1, int(rows * cardinality))
+    header = ['Col%d' % (c + 1) for c in range(columns)]
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+    sheets = []
+    try:
+        for first in range(0, max(rows, 1), sheetrows):
+            sheets.append('Data' if not sheets else 'Data_%d' % (len(sheets) + 1))
+            worksheet = workbook.add_worksheet(sheets[-1])
+            worksheet.write_row(0, 0, header)
+            for r in range(1, min(sheetrows, rows - first) + 1):
+                worksheet.write_row(r, 0, [synthetic_value(rng.randrange(distinct), valuetype)
+                                           for _ in range(columns)])
+    finally:
+        workbook.close()
+    return sheets
+
+
+class PeakMemory(object):
+    """
+    Track the peak resident set size of this process while a block of code runs. psutil is sampled from a
+    background thread when it is installed; otherwise the process-wide peak from the resource module is used.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        try:
+            import psutil
+        except ImportError:
+            return self
+        process = psutil.Process()
+        self.peak = process.memory_info().rss
+
+        def sample():
+            while not self.stopped.wait(self.interval):
+                self.peak = max(self.peak, process.memory_info().rss)
+
+        self.sampler = threading.Thread(target=sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        if self.peak is not None:
+            self.sampler.join()
+            return
+        try:
+            import resource
+        except ImportError:
+            return
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        self.peak = peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_stage(case, stage, workdirectory):
+    """ Run one stage of the hashing logic on a synthetic input, in isolation. Everything the stage depends on
+        (e.g. a populated temporary database for the mapfile writers) is prepared first and not measured. Meant to
+        be run in a fresh process so that peak memory is not inherited from earlier cases.
+
+    :param case: Dictionary with the rows, columns, cardinality and valuetype of the input
+    :param stage: One of stagenames
+    :param workdirectory: Directory holding the generated input files
+    :return: Dictionary with the elapsed seconds, peak resident set size, rows per second and, for end2end, the
+             per-stage statistics of the run
+    """
+    fullname = os.path.join(workdirectory, 'bench_{rows}_{columns}_{cardinality}_{valuetype}.xlsx'.format(**case))
+    sheets = chl.read_sheet_names(fullname)
+    fields2hash = ['Col%d' % (c + 1) for c in range(case['columns'])]
+    cols2hash = list(range(case['columns']))
+    inputdirectory, fileselected = os.path.split(fullname)
+    inputdirectory = os.path.join(inputdirectory, '')
+    outputdirectory = tempfile.mkdtemp(prefix='bench_', dir=workdirectory)
+
+    mychl = chl.ExcelCryptoHash()
+    mychl.identify_hash(5)
+    mychl.initialize_sqlite(inputsize=os.path.getsize(fullname))
+
+    def read():
+        for sheet in sheets:
+            for chunk in chl.read_sheet_chunks(fullname, sheet, fields2hash, cols2hash, mychl.chunksize):
+                yield [chunk[field].dropna().drop_duplicates().tolist() for field in fields2hash]
+
+    def create_temp_db():
+        for sheet in sheets:
+            mychl.create_temp_db(fileselected, sheet, fields2hash, cols2hash, inputdirectory)
+
+    try:
+        if stage in ('hash', 'store'):
+            columns = list(read())
+        if stage == 'store':
+            hashed = [mychl.hash_columns(distinct) for distinct in columns]
+        if stage in ('mapfiles', 'legacymapfiles', 'output'):
+            create_temp_db()
+
+        started = time.perf_counter()
+        with PeakMemory() as memory:
+            if stage == 'read':
+                for _ in read():
+                    pass
+            elif stage == 'hash':
+                for distinct in columns:
+                    mychl.hash_columns(distinct)
+            elif stage == 'store':
+                for distinct, hashvalues in zip(columns, hashed):
+                    for field, plaintexts, digests in zip(fields2hash, distinct, hashvalues):
+                        mychl.store_hashes(field, plaintexts, digests)
+            elif stage == 'mapfiles':
+                mychl.process_hash_mapfiles(fields2hash, '.xlsx', os.path.join(outputdirectory, ''))
+            elif stage == 'legacymapfiles':
+                mychl.process_hash_mapfile_summary('.xlsx', os.path.join(outputdirectory, ''))
+                mychl.process_hash_mapfile_detail(fields2hash, '.xlsx', os.path.join(outputdirectory, ''))
+            elif stage == 'output':
+                mychl.write_hashed_outputfile(fileselected, sheets[0], fields2hash, '.xlsx', inputdirectory,
+                                              os.path.join(outputdirectory, ''))
+            else:
+                create_temp_db()
+                mychl.process_hash_mapfiles(fields2hash, '.xlsx', os.path.join(outputdirectory, ''))
+                mychl.write_hashed_outputfile(fileselected, sheets[0], fields2hash, '.xlsx', inputdirectory,
+                                              os.path.join(outputdirectory, ''))
+        seconds = time.perf_counter() - started
+    finally:
+        mychl.remove_sqlite()
+        shutil.rmtree(outputdirectory, ignore_errors=True)
+
+    result = {'seconds': seconds, 'peak_rss': memory.peak, 'rows_per_sec': case['rows'] / seconds if seconds else None}
+    if stage == 'end2end':
+        result['stages'] = mychl.statistics.report()['stages']
+    return result
+
+
+def run_benchmarks(cases, stages, workdirectory, resultsname, label):
+    """ Run every stage for every case, each in a fresh process, and append the results to a JSON lines file.
+
+    :param cases: List of case dictionaries (rows, columns, cardinality, valuetype)
+    :param stages: Stages to run, from stagenames
+    :param workdirectory: Directory for the generated input files, which are reused between runs
+    :param resultsname: JSON lines file the results are appended to
+    :param label: Label identifying the version being measured
+    """
+    if not os.path.isdir(workdirectory):
+        os.makedirs(workdirectory)
+    context = multiprocessing.get_context('spawn')
+    environment = {'python': platform.python_version(), 'platform': platform.platform(),
+                   'cpus': os.cpu_count()}
+
+    for case in cases:
+        fullname = os.path.join(workdirectory,
+                                'bench_{rows}_{columns}_{cardinality}_{valuetype}.xlsx'.format(**case))
+        if not os.path.exists(fullname):
+            print('generating ' + os.path.basename(fullname), file=sys.stderr)
+            generate_workbook(fullname, case['rows'], case['columns'], case['cardinality'], case['valuetype'])
+
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_stage, case, stage, workdirectory).result()
+            record = {'label': label, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'case': case,
+                      'stage': stage}
+            record.update(result)
+            record.update(environment)
+            with open(resultsname, 'a') as results:
+                results.write(json.dumps(record) + '\n')
+            print('{0:<45} {1:<9} {2:9.2f}s {3:>12} rows/sec {4:>8} MB peak'.format(
+                os.path.basename(fullname), stage, result['seconds'], int(result['rows_per_sec'] or 0),
+                (result['peak_rss'] or 0) // (1024 * 1024)))
+
+
+def case_key(record):
+    case = record['case']
+    return case['rows'], case['columns'], case['cardinality'], case['valuetype'], record['stage']
+
+
+def compare_results(oldname, newname, oldlabel=None, newlabel=None, tolerance=0.1):
+    """ Compare the timings of two benchmark runs case by case.
+
+    :param oldname: JSON lines results of the baseline run
+    :param newname: JSON lines results of the run to compare. May be the same file as oldname.
+    :param oldlabel: Only use records of the baseline with this label (default: all, the latest record wins)
+    :param newlabel: Only use records of the compared run with this label (default: all, the latest record wins)
+    :param tolerance: Fraction by which a case may be slower before it is reported as a regression
+    :return: Number of regressions found
+    """
+    def load(filename, label):
+        records = {}
+        with open(filename) as results:
+            for line in results:
+                record = json.loads(line)
+                if label is None or record['label'] == label:
+                    records[case_key(record)] = record
+        return records
+
+    old = load(oldname, oldlabel)
+    new = load(newname, newlabel)
+    regressions = 0
+    for key in sorted(set(old) & set(new), key=str):
+        ratio = new[key]['seconds'] / old[key]['seconds'] if old[key]['seconds'] else 1.0
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{0:<45} {1:9.2f}s {2:9.2f}s {3:6.2f}x{4}'.format(
+            '{0} rows x{1} {2} {3} {4}'.format(*key), old[key]['seconds'], new[key]['seconds'], ratio, flag))
+    return regressions
+
+
+def measure_startup(module, repeat=5):
+    """ Measure the cold import time of a module, each time in a fresh interpreter.
+
+    :param module: Name of the module to import
+    :param repeat: Number of interpreters started
+    :return: Dictionary with the fastest import in seconds and the deferred modules loaded by the import
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', startupscript.format(module, deferredmodules)],
+                                         cwd=directory)
+        timings.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    return {'seconds': min(timing['seconds'] for timing in timings), 'loaded': timings[-1]['loaded']}
+
+
+def check_startup(modules, budget, repeat=5):
+    """ Check the cold import time of modules against a budget.
+
+    :param modules: Names of the modules to import
+    :param budget: Seconds an import may take at most
+    :param repeat: Number of imports per module; the fastest counts
+    :return: Number of modules over budget or loading a deferred dependency at import time
+    """
+    failures = 0
+    for module in modules:
+        result = measure_startup(module, repeat)
+        flag = ''
+        if result['seconds'] > budget:
+            flag = '  OVER BUDGET'
+        if result['loaded']:
+            flag += '  LOADS ' + ', '.join(result['loaded'])
+        failures += bool(flag)
+        print('{0:<30} {1:9.3f}s {2:9.3f}s budget{3}'.format(module, result['seconds'], budget, flag))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='itellihashexcelbenchmark',
+                                     description='Benchmark the iTelliHashExcel hashing logic on synthetic inputs.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run = subparsers.add_parser('run', help='Run the benchmark grid and append the results to a file')
+    run.add_argument('--rows', default='10000,100000,1000000,5000000',
+                     help='Comma separated row counts (default: %(default)s)')
+    run.add_argument('--columns', default='1,5', help='Comma separated column counts (default: %(default)s)')
+    run.add_argument('--cardinality', default='0.1,1.0',
+                     help='Comma separated fractions of distinct values per column (default: %(default)s)')
+    run.add_argument('--types', default='int,text', help='Comma separated value types, from: ' + ', '.join(valuetypes)
+                     + ' (default: %(default)s)')
+    run.add_argument('--stages', default=','.join(stagenames), help='Comma separated stages (default: %(default)s)')
+    run.add_argument('--quick', action='store_true', help='Only run the smallest case of the grid')
+    run.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'itellihashexcel_benchmark'),
+                     help='Directory for the generated input files (default: %(default)s)')
+    run.add_argument('--results', default='benchmark_results.jsonl',
+                     help='JSON lines file the results are appended to (default: %(default)s)')
+    run.add_argument('--label', default='current', help='Label of the version being measured')
+
+    compare = subparsers.add_parser('compare', help='Compare two sets of results')
+    compare.add_argument('old', help='Results of the baseline')
+    compare.add_argument('new', help='Results to compare against the baseline')
+    compare.add_argument('--old-label', help='Label of the baseline records')
+    compare.add_argument('--new-label', help='Label of the compared records')
+    compare.add_argument('--tolerance', type=float, default=0.1,
+                         help='Fraction a case may be slower before it counts as a regression (default: %(default)s)')
+
+    startup = subparsers.add_parser('startup', help='Check the cold import time of the modules against a budget')
+    startup.add_argument('--modules', default=','.join(startupmodules),
+                         help='Comma separated modules to import (default: %(default)s)')
+    startup.add_argument('--budget', type=float, default=0.3,
+                         help='Seconds an import may take at most (default: %(default)s)')
+    startup.add_argument('--repeat', type=int, default=5,
+                         help='Number of imports per module; the fastest counts (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        grid = itertools.product([int(n) for n in args.rows.split(',')], [int(n) for n in args.columns.split(',')],
+                                 [float(n) for n in args.cardinality.split(',')], args.types.split(','))
+        cases = [{'rows': rows, 'columns': columns, 'cardinality': cardinality, 'valuetype': valuetype}
+                 for rows, columns, cardinality, valuetype in grid]
+        if args.quick:
+            cases = cases[:1]
+        stages = args.stages.split(',')
+        unknown = set(stages).difference(stagenames) | set(case['valuetype'] for case in cases).difference(valuetypes)
+        if unknown:
+            parser.error('unknown stage or value type: ' + ', '.join(sorted(unknown)))
+        run_benchmarks(cases, stages, args.workdir, args.results, args.label)
+    elif args.command == 'compare':
+        return 1 if compare_results(args.old, args.new, args.old_label, args.new_label, args.tolerance) else 0
+    elif args.command == 'startup':
+        return 1 if check_startup(args.modules.split(','), args.budget, args.repeat) else 0
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+# coding: utf-8
+# itellihashexcelcli.py
+# Copyright 2018 iTtelligent, LLC., Kirby J. Davis (kdavis@itelligentllc.com)
+
+"""This file is part of iTelliHashExcel.
+
+    iTelliHashExcel - A Cryptographic Hashing Application for Excel Files
+    Copyright (C) 2018 iTtelligent, LLC (Kirby J. Davis)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+    """
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import excelcryptohashinglogic as chl
+
+
+def expand_inputs(patterns):
+    """ Expand the input file names and glob patterns given on the command line.
+
+    :param patterns: File names and/or glob patterns
+    :return: Sorted list of distinct Excel input files
+    """
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        files.update(matches if matches else [pattern])
+    return sorted(os.path.abspath(f) for f in files if os.path.isfile(f))
+
+
+def select_sources(files, sheets, fields2hash):
+    """ Pair every input file with the sheets to be processed.
+
+    :param files: Excel input files
+    :param sheets: Names of the sheets to process. '*' selects every sheet holding all fields2hash; the first sheet
+                   of each file is used when empty.
+    :param fields2hash: Names of the fields/columns to be hashed
+    :return: List of (file, sheet name) pairs
+    """
+    sources = []
+    for fullname in files:
+        sheetnames = chl.read_sheet_names(fullname)
+        if not sheets:
+            selected = sheetnames[:1]
+        elif '*' in sheets:
+            selected = [sheet for sheet in sheetnames
+                        if set(fields2hash).issubset(chl.read_sheet_header(fullname, sheet))]
+        else:
+            selected = [sheet for sheet in sheets if sheet in sheetnames]
+            if len(selected) != len(sheets):
+                raise ValueError('Sheet(s) not found in {0}: {1}'.format(
+                    fullname, ', '.join(sheet for sheet in sheets if sheet not in sheetnames)))
+        sources.extend((fullname, sheet) for sheet in selected)
+    if not sources:
+        raise ValueError('No sheet holds all of the columns: ' + ', '.join(fields2hash))
+    return sources
+
+
+def process_job(files, outputdirectory, args):
+    """ Run the complete hashing pipeline for one job: either a single Excel input file, or all input files combined
+        into one set of mapfiles. All selected sheets of all files of the job share one temporary database, so every
+        distinct value is hashed once per job.
+
+    :param files: Excel input files of the job
+    :param outputdirectory: Directory for the output files
+    :param args: Parsed command line arguments
+    :return: Description of the outcome: output directory, elapsed time and digest cache statistics. A JSON run
+             report, Hash_RunReport_<hash format>.json, is written to the output directory. With --incremental,
+             the output files are left as they are when none of the inputs changed since the previous run. With
+             --resume, a run interrupted earlier continues from its last checkpoint.
+    """
+    if not os.path.isdir(outputdirectory):
+        os.makedirs(outputdirectory)
+    sources = select_sources(files, args.sheet, args.fields2hash)
+    name = os.path.basename(files[0]) if len(files) == 1 else 'combined'
+
+    mychl = chl.ExcelCryptoHash()
+    mychl.identify_hashes(args.hashes)
+    mychl.parallel = args.workers > 1
+    mychl.workers = args.workers
+    mychl.pipelined = args.pipeline
+    mychl.outputformat = args.format
+    mychl.maxsheetrows = args.max_sheet_rows
+    mychl.textinput = args.text
+    mychl.replacevalues = args.replace_values
+    mychl.normalization = args.normalization
+    mychl.outputworkers = args.output_workers
+    mychl.digestencoding = args.encoding
+    if args.progress:
+        mychl.progress_callback = lambda stage, p: print(
+            '{0}: {stage} {rows} rows, {rows_per_sec:.0f} rows/sec, {percent:.0f}% complete'.format(name, **p),
+            file=sys.stderr)
+    if args.cache:
+        mychl.open_digest_cache(args.cache, args.cache_size)
+    if args.incremental or args.resume:
+        mychl.statefile = outputdirectory + 'Hash_State_' + mychl.hstr + '.db'
+    reportname = outputdirectory + 'Hash_RunReport_' + mychl.hstr + '.json'
+    layout = mychl.estimate_layout(sources, args.fields2hash)
+    if args.progress and layout is not None and args.format == 'xlsx' and layout['summarysheets'] > 1:
+        print('{0}: up to {rows} rows, the mapfiles may be split into up to {summarysheets} summary sheets and '
+              '{detailsheets} detail sheets per column'.format(name, **layout), file=sys.stderr)
+
+    mychl.initialize_sqlite(inputsize=sum(os.path.getsize(fullname) for fullname in files))
+    completed = False
+    try:
+        outputsettings = mychl.output_settings(hashedoutput=args.hashedoutput, lookupstore=args.lookup_store)
+        recordedsettings = None
+        if mychl.dbname == mychl.statefile:
+            # Forgotten until every output is written again, so that a run failing part way never counts as written
+            recordedsettings = mychl.recorded_output_settings()
+            mychl.record_output_settings(None)
+        changes = mychl.create_combined_temp_db(sources, args.fields2hash)
+        # The outputs are only kept when neither the inputs nor the way the outputs are written changed
+        if (args.incremental and not changes and os.path.exists(reportname) and
+                recordedsettings == outputsettings):
+            mychl.record_output_settings(outputsettings)
+            return 'unchanged since the previous run, output in {0} kept'.format(outputdirectory)
+        # One Hashed_ copy of every input file per hash format, with the mapping sheets after its first processed
+        # sheet
+        hashedoutputs = []
+        if args.hashedoutput:
+            for fullname in files:
+                inputdirectory, fileselected = os.path.split(fullname)
+                sheet2process = next((sheet for source, sheet in sources if source == fullname), None)
+                if sheet2process is None:
+                    # None of the sheets of this file holds the columns, see select_sources
+                    continue
+                hashedoutputs.append((fileselected, sheet2process, os.path.splitext(fileselected)[1],
+                                      os.path.join(inputdirectory, '')))
+        mychl.write_outputs(args.fields2hash, os.path.splitext(files[0])[1], outputdirectory, hashedoutputs)
+        if args.lookup_store:
+            mychl.write_lookup_store(args.lookup_store)
+        report = mychl.write_run_report(reportname,
+                                        inputs=[{'file': fullname, 'sheet': sheet} for fullname, sheet in sources],
+                                        columns=args.fields2hash, incremental=args.incremental)
+        if mychl.dbname == mychl.statefile:
+            mychl.record_output_settings(outputsettings)
+        completed = True
+    finally:
+        # A checkpoint is only kept to resume an interrupted run, see --resume
+        mychl.remove_sqlite(removestate=completed and not args.incremental)
+        statistics = mychl.close_digest_cache()
+
+    outcome = 'written to {0} in {1:.1f}s'.format(outputdirectory, report['elapsed'])
+    if statistics is not None:
+        outcome += ' (digest cache: {hits} hits, {misses} misses, {hit_rate:.1%} hit rate)'.format(**statistics)
+    return outcome
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='itellihashexcelcli',
+        description='Hash selected columns of one or more Excel files without the graphical interface.')
+    parser.add_argument('inputs', nargs='+', help='Excel input files or glob patterns (e.g. "extracts/*.xlsx")')
+    parser.add_argument('-s', '--sheet', action='append', default=[],
+                        help='Sheet to process; may be repeated. "*" selects every sheet holding the columns '
+                             '(default: first sheet of each file)')
+    parser.add_argument('-c', '--columns', required=True, help='Comma separated names of the columns to hash')
+    parser.add_argument('-a', '--hash', default='sha512',
+                        help='Cryptographic hash to use, or several comma separated hashes computed in one pass, '
+                             'from: ' + ', '.join(chl.hash_formats) + ' (default: %(default)s)')
+    parser.add_argument('-t', '--text', action='store_true',
+                        help='Read the columns as the text recorded in the workbook instead of typed values, e.g. '
+                             'numbers as written and dates as serial numbers')
+    parser.add_argument('-n', '--normalize', action='append', default=[], metavar='COLUMN=RULES',
+                        help='Normalize the values of a column before hashing; may be repeated. RULES is a comma '
+                             'separated list of: trim, casefold, zfill:<width>, punct (strip punctuation), applied '
+                             'in order. COLUMN "*" applies to every column.')
+    parser.add_argument('-o', '--output-dir',
+                        help='Directory for the output files (default: directory of each input file, or the '
+                             'current directory with --combine). Without --combine each input file gets its own '
+                             'sub-directory.')
+    parser.add_argument('--combine', action='store_true',
+                        help='Process all input files as one job: values are de-duplicated across all files and '
+                             'sheets, hashed once and written to one combined set of mapfiles')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of files processed concurrently (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of hashing worker processes per job (default: the number of CPUs, shared '
+                             'between the jobs processed concurrently)')
+    parser.add_argument('--output-workers', type=int, default=1,
+                        help='Number of worker processes writing the summary and detail mapfiles and the Hashed_ '
+                             'copies concurrently (default: %(default)s)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Read, hash and store consecutive chunks concurrently; most effective together with '
+                             '--workers')
+    parser.add_argument('-f', '--format', choices=('xlsx',) + tuple(sorted(chl.mapfile_writers)), default='xlsx',
+                        help='Format of the summary and detail mapfiles (default: %(default)s)')
+    parser.add_argument('-e', '--encoding', choices=sorted(chl.digest_encodings), default='hex',
+                        help='Text encoding of the hash values in the Excel and CSV output; Parquet mapfiles hold '
+                             'binary digests (default: %(default)s)')
+    parser.add_argument('--max-sheet-rows', type=int, default=chl.excel_max_rows,
+                        help='Maximum number of rows, including the header row, of a mapping sheet in the Excel '
+                             'output; further rows roll over to numbered sheets (default: %(default)s)')
+    parser.add_argument('--replace-values', action='store_true',
+                        help='Write the hash values in place of the values of the hashed columns in the Hashed_ copy, '
+                             'instead of adding mapping sheets, so that it holds none of their plaintext values')
+    parser.add_argument('--no-hashed-output', dest='hashedoutput', action='store_false',
+                        help='Do not create the Hashed_ copy of the input file')
+    parser.add_argument('-v', '--progress', action='store_true',
+                        help='Report rows and rows/sec of every stage while processing')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Persistent digest cache file. Values found in the cache are not hashed again.')
+    parser.add_argument('--lookup-store', metavar='FILE',
+                        help='Also add the mappings to this reverse-lookup store, which itellihashexcellookup '
+                             'resolves hash values against')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep the mappings and the fingerprints of the inputs in a state file in the output '
+                             'directory, so that a rerun only reads, hashes and writes what changed')
+    parser.add_argument('--resume', action='store_true',
+                        help='Checkpoint every chunk to a state file in the output directory while processing, so '
+                             'that an interrupted run continues from its last checkpoint when run again with '
+                             '--resume. The state file is removed once the run completes, unless --incremental.')
+    parser.add_argument('--cache-size', type=int, default=10000000,
+                        help='Maximum number of entries kept in the digest cache (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        parser.error('no input files found')
+    args.fields2hash = [field.strip() for field in args.columns.split(',') if field.strip()]
+    args.hashes = [hstr.strip().lower() for hstr in args.hash.split(',') if hstr.strip()]
+    unknown = [hstr for hstr in args.hashes if hstr not in chl.hash_formats]
+    if unknown or not args.hashes:
+        parser.error('unknown hash: ' + ', '.join(unknown))
+    args.normalization = {}
+    for normalize in args.normalize:
+        column, separator, rules = normalize.partition('=')
+        if not separator:
+            parser.error('--normalize expects COLUMN=RULES: ' + normalize)
+        try:
+            rules = chl.parse_normalization(rules)
+        except ValueError as e:
+            parser.error(str(e))
+        for field in (args.fields2hash if column.strip() == '*' else [column.strip()]):
+            if field not in args.fields2hash:
+                parser.error('--normalize refers to a column not being hashed: ' + field)
+            args.normalization[field] = args.normalization.get(field, []) + rules
+    if not 2 <= args.max_sheet_rows <= chl.excel_max_rows:
+        parser.error('--max-sheet-rows must be between 2 and {0}'.format(chl.excel_max_rows))
+    if args.cache:
+        args.cache = os.path.abspath(args.cache)
+    if args.lookup_store:
+        args.lookup_store = os.path.abspath(args.lookup_store)
+    outputdirectory = os.path.abspath(args.output_dir) if args.output_dir else None
+
+    if args.combine:
+        jobs = [(files, os.path.join(outputdirectory or os.getcwd(), ''))]
+    else:
+        jobs = [([fullname], os.path.join(outputdirectory or os.path.dirname(fullname),
+                                          os.path.splitext(os.path.basename(fullname))[0], ''))
+                for fullname in files]
+
+    if args.workers is None:
+        args.workers = max(1, (os.cpu_count() or 1) // max(1, min(args.jobs, len(jobs))))
+
+    failures = 0
+    if args.jobs <= 1 or len(jobs) == 1:
+        for jobfiles, joboutput in jobs:
+            try:
+                print(', '.join(jobfiles) + ': ' + process_job(jobfiles, joboutput, args))
+            except Exception as e:
+                failures += 1
+                print(', '.join(jobfiles) + ': failed: ' + str(e), file=sys.stderr)
+    else:
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(jobs))) as executor:
+            futures = dict((executor.submit(process_job, jobfiles, joboutput, args), jobfiles)
+                           for jobfiles, joboutput in jobs)
+            for future in as_completed(futures):
+                try:
+                    print(', '.join(futures[future]) + ': ' + future.result())
+                except Exception as e:
+                    failures += 1
+                    print(', '.join(futures[future]) + ': failed: ' + str(e), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# coding: utf-8
+# itellihashexcellookup.py
+# Copyright 2018 iTtelligent, LLC., Kirby J. Davis (kdavis@itelligentllc.com)
+
+"""This file is part of iTelliHashExcel.
+
+    iTelliHashExcel - A Cryptographic Hashing Application for Excel Files
+    Copyright (C) 2018 iTtelligent, LLC (Kirby J. Davis)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+    """
+
+import argparse
+import csv
+import sys
+
+import excelcryptohashinglogic as chl
+
+
+def read_hashvalues(hashvalues, inputnames):
+    """ Collect the hash values to resolve from the command line and from files.
+
+    :param hashvalues: Hash values given on the command line
+    :param inputnames: Files holding one hash value per line; '-' reads standard input
+    :return: Generator of hash values
+    """
+    for hashvalue in hashvalues:
+        yield hashvalue
+    for inputname in inputnames:
+        inputfile = sys.stdin if inputname == '-' else open(inputname)
+        try:
+            for line in inputfile:
+                if line.strip():
+                    yield line.strip()
+        finally:
+            if inputfile is not sys.stdin:
+                inputfile.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='itellihashexcellookup',
+        description='Resolve hash values back to their plaintext values using a lookup store written by '
+                    'itellihashexcelcli --lookup-store.')
+    parser.add_argument('store', help='Lookup store file')
+    parser.add_argument('hashvalues', nargs='*', help='Hex hash values to resolve')
+    parser.add_argument('-i', '--input', action='append', default=[],
+                        help='File with one hash value per line; "-" reads standard input. May be repeated.')
+    parser.add_argument('-a', '--hash', choices=chl.hash_formats,
+                        help='Only resolve hash values of this hash format (default: any)')
+    parser.add_argument('-o', '--output', help='CSV file for the results (default: standard output)')
+    parser.add_argument('-b', '--batch', type=int, default=100000,
+                        help='Number of hash values resolved per query (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    store = chl.LookupStore(args.store)
+    outputfile = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    resolved = unresolved = 0
+    try:
+        writer = csv.writer(outputfile)
+        writer.writerow(('Hashvalue', 'HashFormat', 'ColumnName', 'Plaintext'))
+        for batch in chl.chunked(read_hashvalues(args.hashvalues, args.input), args.batch):
+            for hashvalue, mappings in store.resolve(batch, args.hash).items():
+                if mappings:
+                    resolved += 1
+                    writer.writerows((hashvalue,) + mapping for mapping in mappings)
+                else:
+                    unresolved += 1
+                    writer.writerow((hashvalue, '', '', ''))
+    finally:
+        store.close()
+        if outputfile is not sys.stdout:
+            outputfile.close()
+    print('{0} resolved, {1} not found'.format(resolved, unresolved), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())